@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+"""Columnar cache files and row store.
+
+A cache file starts with ``MAGIC`` and the name of the compression codec of
+its frames (see ``dbcut.compression``), then holds one frame per batch, each
+frame being prefixed by its length. A frame stores the rows of every table of the
+batch as typed column chunks (arrays of integers and floats, length-prefixed
+strings and bytes) so that it is read back without SQLAlchemy and its rows are
+inserted as is.
+
+The cache files of the queries only hold the keys of their rows, the rows
+themselves being stored once per ``(table, key)`` in the ``RowStore`` shared
+by all the queries of a source database.
+"""
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+from .compression import get_codec
+from .extractor import RowBatch, chunked, get_key_columns, get_row_key
+
+__all__ = [
+    "ColumnarReader",
+    "ColumnarWriter",
+    "RowStore",
+    "decode_batch",
+    "encode_batch",
+    "is_cache_file",
+    "read_cache_keys",
+]
+
+MAGIC = b"DBCUT-COLUMNAR-2\n"
+
+_FRAME_HEADER = struct.Struct("<Q")
+_INT64_MIN, _INT64_MAX = -(2 ** 63), 2 ** 63 - 1
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+def _to_bytes(values):
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if _BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def encode_column(values):
+    """Encode a list of values of one column as a ``(kind, data...)`` chunk.
+
+    Integers and floats are stored in arrays, ``None`` values being listed
+    apart, strings and bytes as their lengths (in characters for strings)
+    followed by their concatenated content. Other types are pickled.
+    """
+    types = set(type(value) for value in values)
+    types.discard(type(None))
+    if types == {int} and all(
+        _INT64_MIN <= value <= _INT64_MAX for value in values if value is not None
+    ):
+        return _encode_numbers("i", "q", values)
+    if types == {float}:
+        return _encode_numbers("f", "d", values)
+    if types == {bool}:
+        return ("?", bytes(2 if value is None else value for value in values))
+    if types == {str}:
+        return _encode_buffers("s", values, "")
+    if types == {bytes}:
+        return _encode_buffers("b", values, b"")
+    if not types:
+        return ("n", len(values))
+    return ("o", pickle.dumps(values, pickle.HIGHEST_PROTOCOL))
+
+
+def _encode_numbers(kind, typecode, values):
+    nulls = array("q", (i for i, value in enumerate(values) if value is None))
+    if nulls:
+        values = [0 if value is None else value for value in values]
+    return (kind, _to_bytes(array(typecode, values)), _to_bytes(nulls))
+
+
+def _encode_buffers(kind, values, empty):
+    lengths = array("q", (-1 if value is None else len(value) for value in values))
+    data = empty.join(value for value in values if value is not None)
+    if kind == "s":
+        data = data.encode("utf-8", "surrogatepass")
+    return (kind, _to_bytes(lengths), data)
+
+
+def decode_column(chunk):
+    """Decode a chunk built by ``encode_column`` into a list of values."""
+    kind = chunk[0]
+    if kind in ("i", "f"):
+        values = _from_bytes("q" if kind == "i" else "d", chunk[1]).tolist()
+        for i in _from_bytes("q", chunk[2]):
+            values[i] = None
+        return values
+    if kind == "?":
+        return [None if value == 2 else bool(value) for value in chunk[1]]
+    if kind in ("s", "b"):
+        data = chunk[2]
+        if kind == "s":
+            data = data.decode("utf-8", "surrogatepass")
+        values = []
+        offset = 0
+        for length in _from_bytes("q", chunk[1]):
+            if length < 0:
+                values.append(None)
+            else:
+                values.append(data[offset : offset + length])
+                offset += length
+        return values
+    if kind == "n":
+        return [None] * chunk[1]
+    return pickle.loads(chunk[1])
+
+
+def encode_batch(batch):
+    """Encode a ``RowBatch`` as a frame of bytes.
+
+    The rows of a table are split into runs of consecutive rows with the same
+    columns, each run being stored as one chunk per column.
+    """
+    tables = []
+    for table_name, rows in batch.rows.items():
+        runs = []
+        for row in rows:
+            columns = tuple(row.keys())
+            if not runs or runs[-1][0] != columns:
+                runs.append((columns, []))
+            runs[-1][1].append(tuple(row.values()))
+        tables.append(
+            (
+                table_name,
+                [
+                    (columns, [encode_column(list(c)) for c in zip(*values)])
+                    for columns, values in runs
+                ],
+            )
+        )
+    frame = (batch.count, batch.last_key, tables)
+    return pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+
+
+def decode_batch(data):
+    """Decode a frame built by ``encode_batch`` into a ``RowBatch``."""
+    count, last_key, tables = pickle.loads(data)
+    rows = OrderedDict()
+    for table_name, runs in tables:
+        table_rows = rows.setdefault(table_name, [])
+        for columns, chunks in runs:
+            table_rows.extend(
+                dict(zip(columns, values))
+                for values in zip(*(decode_column(chunk) for chunk in chunks))
+            )
+    return RowBatch(rows, count, last_key)
+
+
+class ColumnarWriter(object):
+    """Append ``RowBatch`` frames to a cache file, compressed with ``codec``."""
+
+    def __init__(self, fd, codec=None):
+        self.fd = fd
+        self.codec = codec or get_codec("none")
+        self.fd.write(MAGIC + self.codec.name.encode("ascii") + b"\n")
+
+    def write(self, batch):
+        frame = self.codec.compress(encode_batch(batch))
+        self.fd.write(_FRAME_HEADER.pack(len(frame)))
+        self.fd.write(frame)
+        return len(frame)
+
+
+class ColumnarReader(object):
+    """Iterate over the ``RowBatch`` frames of a cache file."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a dbcut cache file" % getattr(fd, "name", fd))
+        self.codec = get_codec(fd.readline().rstrip(b"\n").decode("ascii"))
+
+    def __iter__(self):
+        for frame in self.frames():
+            yield decode_batch(frame)
+
+    def frames(self):
+        """Iterate over the decompressed frames of the file."""
+        while True:
+            header = self.fd.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                return
+            (length,) = _FRAME_HEADER.unpack(header)
+            yield self.codec.decompress(self.fd.read(length))
+
+
+def read_cache_keys(path):
+    """Return the keys of the rows of a query cache file, as a mapping of
+    table names to sets of keys."""
+    keys = {}
+    with open(path, "rb") as fd:
+        for batch in ColumnarReader(fd):
+            for table_name, rows in batch.rows.items():
+                keys.setdefault(table_name, set()).update(
+                    tuple(row.values()) for row in rows
+                )
+    return keys
+
+
+def is_cache_file(path):
+    try:
+        with open(path, "rb") as fd:
+            return fd.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class RowStore(object):
+    """Rows of the cached queries, stored once per ``(table, key)`` in a
+    SQLite database.
+
+    Queries sharing rows store them once, and the rows of a query that is not
+    cached yet can be taken from the rows stored by other queries so that only
+    the missing ones are fetched from the source database. Each row is
+    compressed with ``codec``. The rows read from the store and fetched
+    because they were missing are counted in ``stats`` (see ``CacheStats``).
+    The rows of a table are dropped once its definition changes (see
+    ``invalidate``).
+    """
+
+    def __init__(self, path, codec=None, stats=None):
+        self.path = path
+        self.codec = codec or get_codec("none")
+        self.stats = stats
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS rows ("
+                    "table_name TEXT NOT NULL, "
+                    "key TEXT NOT NULL, "
+                    "codec TEXT NOT NULL, "
+                    "row BLOB NOT NULL, "
+                    "PRIMARY KEY (table_name, key)) WITHOUT ROWID"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS tables ("
+                    "table_name TEXT NOT NULL PRIMARY KEY, "
+                    "fingerprint TEXT NOT NULL)"
+                )
+        return self._connection
+
+    def invalidate(self, fingerprints):
+        """Remove the stored rows of the tables whose fingerprint differs
+        from ``fingerprints``, a mapping of table names to the hash of their
+        definition, and record these fingerprints. Returns the names of the
+        invalidated tables."""
+        with self._lock, self.connection as connection:
+            stored = dict(connection.execute("SELECT * FROM tables"))
+            changed = sorted(
+                name
+                for name in set(stored) | set(fingerprints)
+                if stored.get(name) != fingerprints.get(name)
+            )
+            for name in changed:
+                connection.execute("DELETE FROM rows WHERE table_name = ?", (name,))
+                if name in fingerprints:
+                    connection.execute(
+                        "INSERT OR REPLACE INTO tables VALUES (?, ?)",
+                        (name, fingerprints[name]),
+                    )
+                else:
+                    connection.execute(
+                        "DELETE FROM tables WHERE table_name = ?", (name,)
+                    )
+        return changed
+
+    def put(self, table_name, rows):
+        """Store ``rows``, an iterable of ``(key, row)``, replacing the
+        previous rows with the same keys."""
+        codec = self.codec
+        values = [
+            (
+                table_name,
+                repr(key),
+                codec.name,
+                codec.compress(pickle.dumps(dict(row), pickle.HIGHEST_PROTOCOL)),
+            )
+            for key, row in rows
+        ]
+        with self._lock, self.connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)", values
+            )
+
+    def get(self, table_name, keys, count_hits=True):
+        """Return the stored rows of ``keys`` by key, counted as hits unless
+        ``count_hits`` is false."""
+        keys_by_repr = dict((repr(key), key) for key in keys)
+        rows = {}
+        size = 0
+        with self._lock:
+            # 999 is the lowest limit of the number of SQLite bound parameters
+            for chunk in chunked(list(keys_by_repr), 998):
+                result = self.connection.execute(
+                    "SELECT key, codec, row FROM rows "
+                    "WHERE table_name = ? AND key IN (%s)"
+                    % ", ".join("?" * len(chunk)),
+                    [table_name] + chunk,
+                )
+                for key, codec, row in result:
+                    row = get_codec(codec).decompress(row)
+                    rows[keys_by_repr[key]] = pickle.loads(row)
+                    size += len(row)
+        if self.stats is not None and count_hits:
+            self.stats.incr("rows_hits", len(rows))
+            self.stats.incr("bytes_saved", size)
+        return rows
+
+    def total_size(self):
+        """Return the size of all the stored rows, as stored."""
+        with self._lock:
+            (size,) = self.connection.execute(
+                "SELECT SUM(LENGTH(row)) FROM rows"
+            ).fetchone()
+        return size or 0
+
+    def size(self, table_name, keys):
+        """Return the size of the stored rows of ``keys``, as stored."""
+        size = 0
+        with self._lock:
+            for chunk in chunked([repr(key) for key in keys], 998):
+                (chunk_size,) = self.connection.execute(
+                    "SELECT SUM(LENGTH(row)) FROM rows "
+                    "WHERE table_name = ? AND key IN (%s)"
+                    % ", ".join("?" * len(chunk)),
+                    [table_name] + chunk,
+                ).fetchone()
+                size += chunk_size or 0
+        return size
+
+    def delete(self, table_name, keys):
+        """Remove the stored rows of ``keys``. Returns the number of removed
+        rows. Their pages are reused by the next stored rows (see
+        ``disk_usage``)."""
+        removed = 0
+        with self._lock:
+            connection = self.connection
+            with connection:
+                for chunk in chunked([repr(key) for key in keys], 998):
+                    removed += connection.execute(
+                        "DELETE FROM rows WHERE table_name = ? AND key IN (%s)"
+                        % ", ".join("?" * len(chunk)),
+                        [table_name] + chunk,
+                    ).rowcount
+        return removed
+
+    def disk_usage(self):
+        """Size of the pages of the database file in use, without the free
+        pages of the removed rows."""
+        with self._lock:
+            connection = self.connection
+            (page_size,) = connection.execute("PRAGMA page_size").fetchone()
+            (page_count,) = connection.execute("PRAGMA page_count").fetchone()
+            (free_count,) = connection.execute("PRAGMA freelist_count").fetchone()
+        return page_size * (page_count - free_count)
+
+    def iter_encoded_rows(self, limit=None):
+        """Iterate over the stored rows, decompressed but still pickled."""
+        with self._lock:
+            result = self.connection.execute(
+                "SELECT codec, row FROM rows LIMIT ?", (-1 if limit is None else limit,)
+            ).fetchall()
+        for codec, row in result:
+            yield get_codec(codec).decompress(row)
+
+    def store_batch(self, batch, tables):
+        """Store the rows of ``batch`` and return the batch of their keys."""
+        keys = OrderedDict()
+        for table_name, rows in batch.rows.items():
+            table = tables[table_name]
+            key_columns = [c.key for c in get_key_columns(table)]
+            rows_by_key = OrderedDict((get_row_key(table, row), row) for row in rows)
+            self.put(table_name, rows_by_key.items())
+            keys[table_name] = [
+                OrderedDict(zip(key_columns, key)) for key in rows_by_key
+            ]
+        return RowBatch(keys, batch.count, batch.last_key)
+
+    def load_batch(self, batch, tables, fetch_missing):
+        """Return the batch of the rows of the keys of ``batch``.
+
+        The rows missing from the store are fetched with
+        ``fetch_missing(table, keys)``, returning them by key, and stored.
+        """
+        rows = OrderedDict()
+        stored_keys = {}
+        for table_name, key_rows in batch.rows.items():
+            table = tables[table_name]
+            keys = [get_row_key(table, row) for row in key_rows]
+            stored_rows = self.get(table_name, keys)
+            stored_keys[table_name] = set(stored_rows)
+            missing_keys = [key for key in keys if key not in stored_rows]
+            if missing_keys:
+                if self.stats is not None:
+                    self.stats.incr("rows_misses", len(missing_keys))
+                fetched_rows = fetch_missing(table, missing_keys)
+                self.put(table_name, fetched_rows.items())
+                stored_rows.update(fetched_rows)
+            rows[table_name] = [stored_rows[key] for key in keys if key in stored_rows]
+        return RowBatch(rows, batch.count, batch.last_key, stored_keys)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ...compression import CODECS
+from ..context import global_options, pass_context, profiler_option
+from ..operations import bench_cache
+
+
+@click.command("benchcache")
+@profiler_option()
+@click.option(
+    "--codec",
+    "codecs",
+    type=click.Choice(list(CODECS)),
+    multiple=True,
+    help="Benchmark only these codecs (all available codecs by default)",
+)
+@click.option(
+    "--max-rows",
+    "max_rows",
+    type=int,
+    default=100000,
+    show_default=True,
+    help="Number of rows of the row store to benchmark",
+)
+@global_options()
+@pass_context
+def cli(ctx, codecs, max_rows, **kwargs):
+    """Benchmark the compression codecs on the cache."""
+    bench_cache(ctx, codecs, max_rows)
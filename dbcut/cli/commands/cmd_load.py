@@ -4,6 +4,9 @@
 
 import click
 
+from ...extractor import ENGINES
+from ...loader import LOADERS
+from ...query import COUNT_MODES
 from ..context import global_options, pass_context, profiler_option
 from ..operations import load
 
@@ -32,6 +35,13 @@ def load_options():
                 default=False,
                 help="Force refresh all cached queries",
             ),
+            click.option(
+                "--incremental-refresh",
+                "incremental_refresh",
+                is_flag=True,
+                default=False,
+                help="Refresh cached queries with the rows changed since then",
+            ),
             click.option(
                 "-l",
                 "--last-only",
@@ -39,6 +49,56 @@ def load_options():
                 default=False,
                 help="Executes only the last query",
             ),
+            click.option(
+                "--batch-size",
+                "batch_size",
+                type=int,
+                default=None,
+                help="Fetch, insert and commit objects by batches of this size",
+            ),
+            click.option(
+                "--loader",
+                "loader",
+                type=click.Choice(LOADERS),
+                default=None,
+                help="Use the native bulk load of the target database or INSERTs",
+            ),
+            click.option(
+                "-j",
+                "--jobs",
+                "jobs",
+                type=int,
+                default=None,
+                help="Number of queries fetched concurrently",
+            ),
+            click.option(
+                "--queue-depth",
+                "queue_depth",
+                type=int,
+                default=None,
+                help="Number of fetched batches buffered per query before insertion",
+            ),
+            click.option(
+                "--plan",
+                "plan",
+                is_flag=True,
+                default=None,
+                help="Merge all queries and fetch and insert each table once",
+            ),
+            click.option(
+                "--engine",
+                "engine",
+                type=click.Choice(ENGINES),
+                default=None,
+                help="Fetch ORM objects or plain rows with Core statements",
+            ),
+            click.option(
+                "--count",
+                "count",
+                type=click.Choice(COUNT_MODES),
+                default=None,
+                help="Count the objects of the queries before fetching them",
+            ),
         ]
         for option in options:
             option(f)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+from ...extractor import ENGINES
+from ..context import global_options, pass_context, profiler_option
+from ..operations import warm_cache
+
+
+@click.command("warmcache")
+@profiler_option()
+@click.option(
+    "--only",
+    "only_tables",
+    help="Warm only the queries of the given tables",
+    multiple=True,
+)
+@click.option(
+    "-l",
+    "--last-only",
+    is_flag=True,
+    default=False,
+    help="Warm only the last query",
+)
+@click.option(
+    "--max-age",
+    "max_age",
+    default=None,
+    help="Fetch again the queries cached before this duration (e.g. 12h, 7d)",
+)
+@click.option(
+    "--force-refresh",
+    "force_refresh",
+    is_flag=True,
+    default=False,
+    help="Fetch again all the cached queries",
+)
+@click.option(
+    "--incremental-refresh",
+    "incremental_refresh",
+    is_flag=True,
+    default=False,
+    help="Refresh cached queries with the rows changed since then",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    "jobs",
+    type=int,
+    default=None,
+    help="Number of queries fetched concurrently",
+)
+@click.option(
+    "--batch-size",
+    "batch_size",
+    type=int,
+    default=None,
+    help="Fetch objects by batches of this size",
+)
+@click.option(
+    "--engine",
+    "engine",
+    type=click.Choice(ENGINES),
+    default=None,
+    help="Fetch ORM objects or plain rows with Core statements",
+)
+@global_options()
+@pass_context
+def cli(ctx, **kwargs):
+    """Fetch the missing and stale queries into the cache."""
+    warm_cache(ctx)
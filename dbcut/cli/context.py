@@ -37,6 +37,7 @@ class Context(object):
             "export_json",
             "drop_db",
             "force_refresh",
+            "incremental_refresh",
             "last_only",
             "no_cache",
             "profiler",
@@ -47,6 +48,14 @@ class Context(object):
         for flag in self.flags:
             setattr(self, flag, False)
         self.only_tables = []
+        self.batch_size = None
+        self.loader = None
+        self.jobs = None
+        self.queue_depth = None
+        self.plan = None
+        self.engine = None
+        self.count = None
+        self.max_age = None
         self._log_configured = False
         self.is_tty = sys.stdout.isatty()
         self.tty_columns, self.tty_rows = shutil.get_terminal_size(fallback=(80, 24))
@@ -82,6 +91,9 @@ class Context(object):
             echo_sql=False,
             cache_dir=self.config["cache"],
             enable_cache=(not self.no_cache),
+            cache_compression=self.config["cache_compression"],
+            change_tracking_columns=self.config["change_tracking_columns"],
+            soft_delete_column=self.config["soft_delete_column"],
         )
 
     def configure_log(self):
@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 import os
-from contextlib import contextmanager
-from itertools import chain
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from queue import Full, Queue
 
+import click
+from sqlalchemy.orm import configure_mappers
 from tabulate import tabulate
 from tqdm import tqdm
 
+from ..cache import ColumnarReader
+from ..compression import CACHES, CODECS, benchmark_codec, get_codec, read_compressed
+from ..extractor import ExtractionPlan, RowBatch
+from ..loader import PrimaryKeyIndex, get_loader, objects_to_rows
+from ..manifest import evict_cache
 from ..parser import parse_query
-from ..serializer import dump_yaml
+from ..serializer import JSONListWriter, dump_yaml
 from ..sqlalchemy_utils import create_database, database_exists, drop_database
-from ..utils import get_directory_size, silent_sqlalchemy_warnings, to_unicode
+from ..utils import parse_duration, parse_size, silent_sqlalchemy_warnings, to_unicode
 
 
 def get_raw_queries(ctx):
@@ -38,51 +47,211 @@ def db_profiling(ctx):
         ctx.dest_db.profiler_stats()
 
 
-def get_objects_generator(ctx, query, session):
+def get_batch_size(ctx):
+    return ctx.batch_size or ctx.config["batch_size"]
 
-    if ctx.no_cache or ctx.force_refresh or not query.is_cached:
-        using_cache = False
-        count = query.count()
-        generator = query.objects()
-    else:
-        using_cache = True
-        count, data = query.load_from_cache(session=session)
-        generator = (obj for obj in data)
 
-    def objects_generator():
-        progressbar = None
+def get_loader_name(ctx):
+    if ctx.dump_sql:
+        # Native bulk loads are not echoed as SQL statements
+        return "insert"
+    return ctx.loader or ctx.config["loader"]
 
-        obj = next(generator, None)
-        if obj is not None:
-            fetch_generator = chain([obj], generator)
-        else:
-            fetch_generator = generator
 
-        yield
+def get_queue_depth(ctx):
+    return max(1, ctx.queue_depth or ctx.config["queue_depth"])
 
-        if not using_cache:
-            progressbar = tqdm(total=count, leave=False)
 
-        for obj in fetch_generator:
-            yield obj
-            if progressbar is not None:
-                progressbar.update(1)
+def get_jobs(ctx):
+    if ctx.interactive:
+        return 1
+    return max(1, ctx.jobs or ctx.config["jobs"])
 
-        if progressbar is not None:
-            progressbar.close()
 
-    return objects_generator(), count, using_cache
+def get_count_mode(ctx):
+    mode = ctx.count or ctx.config["count"]
+    if mode is True:
+        return "exact"
+    return mode or "none"
 
 
-def save_query_cache(ctx, query, objects):
-    if ctx.no_cache:
-        return
-    if ctx.force_refresh or not query.is_cached:
-        query.save_to_cache(objects=objects)
+def get_engine(ctx):
+    return ctx.engine or ctx.config["engine"]
+
+
+def use_plan(ctx):
+    return bool(ctx.plan or ctx.config["plan"])
+
+
+def prepare_query(ctx, query):
+    query.engine = get_engine(ctx)
+    query.temp_table_threshold = ctx.config["temp_table_threshold"]
+
+
+def refresh_cached_query(ctx, query):
+    """Refresh the cached ``query`` with the rows changed since it was cached
+    (see ``dbcut.query.CacheRefresher``). Returns the ``RefreshResult``, or
+    ``None`` if the query is not cached."""
+    if not query.is_cached:
+        return None
+    lock = query.cache_lock()
+    lock.acquire()
+    try:
+        if not query.is_cached:
+            return None
+        result = query.refresh_cache()
+    finally:
+        lock.release()
+    ctx.log(
+        " ---> Refreshed cache ({} rows fetched again, {} deleted)".format(*result),
+        quietable=True,
+    )
+    return result
+
+
+def get_objects_generator(ctx, query, session, refresh=False):
+    """Return the batches of objects of ``query`` (an ``ObjectsGenerator``),
+    read from the cache or fetched (and cached), their estimated count and
+    whether they are read from the cache. With ``refresh``, the cached query
+    is fetched again as with ``--force-refresh``."""
+    batch_size = get_batch_size(ctx)
+    prepare_query(ctx, query)
+    force_refresh = ctx.force_refresh or refresh
+    # the cache holds rows, the objects graphs exported by the orm engine are
+    # always fetched from the source database (the cache is only filled)
+    export_objects = ctx.export_json and query.engine == "orm"
+
+    if ctx.incremental_refresh and not (
+        ctx.no_cache or force_refresh or export_objects
+    ):
+        refresh_cached_query(ctx, query)
+
+    lock = None
+    if not ctx.no_cache and (force_refresh or not query.is_cached):
+        # only one thread or process fetches a query at once, the others wait
+        # for its lock and then read it from the cache
+        lock = query.cache_lock()
+        lock.acquire()
+        if not force_refresh and query.is_cached:
+            lock.release()
+            lock = None
+
+    try:
+        if ctx.no_cache or force_refresh or export_objects or not query.is_cached:
+            using_cache = False
+            if lock is not None:
+                query.session.db.cache_stats.incr("misses")
+                if not force_refresh:
+                    # rows stored by other queries are not fetched again
+                    query.row_store = query.session.db.row_store
+            count = query.prefetch_count(get_count_mode(ctx))
+            batches = query.iter_batches(batch_size)
+        else:
+            using_cache = True
+            query.session.db.cache_stats.incr("hits")
+            count, batches = query.load_from_cache()
+    except BaseException:
+        if lock is not None:
+            lock.release()
+        raise
+
+    return ObjectsGenerator(query, batches, lock), count, using_cache
+
+
+class ObjectsGenerator(object):
+    """Iterator over the ``batches`` of ``query``, which are written to the
+    cache while its cache ``lock`` is held.
+
+    The lock is released once the batches are exhausted or closed, even if
+    they were never iterated (a query skipped or without objects).
+    """
+
+    def __init__(self, query, batches, lock=None):
+        self.query = query
+        self.lock = lock
+        self.generator = self._generate(batches)
+
+    def _generate(self, batches):
+        with ExitStack() as stack:
+            cache_writer = None
+            if self.lock is not None:
+                cache_writer = stack.enter_context(self.query.cache_writer())
+
+            self.query.fetched_count = 0
+            for batch in batches:
+                if cache_writer is not None:
+                    cache_writer.write(batch)
+                self.query.fetched_count += len(batch)
+                yield batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.generator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            self.generator.close()
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+                self.lock = None
+
+
+def with_progressbar(objects_generator, count):
+    with ExitStack() as stack:
+        progressbar = None
+        for batch in objects_generator:
+            if progressbar is None:
+                progressbar = stack.enter_context(tqdm(total=count, leave=False))
+            yield batch
+            progressbar.update(len(batch))
+            if progressbar.total is not None and progressbar.n > progressbar.total:
+                # the count was underestimated
+                progressbar.total = progressbar.n
+                progressbar.refresh()
+
+
+def write_batches(ctx, query, objects_generator, session, loader):
+    inserted_rows = 0
+    with ExitStack() as stack:
+        if ctx.export_json:
+            json_writer = stack.enter_context(JSONListWriter(query.json_file))
+
+        for batch in objects_generator:
+            if isinstance(batch, RowBatch):
+                if ctx.export_json:
+                    json_writer.write([batch.rows])
+                else:
+                    inserted_rows += loader.load(batch.rows)
+                    session.commit()
+            elif ctx.export_json:
+                json_writer.write(batch)
+            else:
+                inserted_rows += loader.load(objects_to_rows(batch))
+                session.commit()
 
+    return inserted_rows
 
-def copy_query(ctx, query, session, query_index, number_of_queries):
-    objects_generator, count, using_cache = get_objects_generator(ctx, query, session)
+
+def copy_query(
+    ctx, query, session, loader, query_index, number_of_queries, fetched=None
+):
+    if fetched is None:
+        fetched = get_objects_generator(ctx, query, session)
+        # release the cache lock of the query even if it is skipped
+        with closing(fetched[0]):
+            return copy_query(
+                ctx, query, session, loader, query_index, number_of_queries, fetched
+            )
+    objects_generator, count, using_cache = fetched
+    if not using_cache:
+        objects_generator = with_progressbar(objects_generator, count)
 
     ctx.log("")
     ctx.log("Query %d/%d : " % ((query_index + 1), number_of_queries), nl=False)
@@ -108,20 +277,20 @@ def copy_query(ctx, query, session, query_index, number_of_queries):
         else:
             ctx.log(" ---> Executing query")
 
-        next(objects_generator)
-
-        if count:
+        # only an exact count of 0 objects is trusted to skip the query
+        if count != 0:
             ctx.log(" ---> Fetching objects")
-            objects_to_serialize = list(objects_generator)
-            save_query_cache(ctx, query, objects_to_serialize)
-
             if ctx.export_json:
                 ctx.log(" ---> Exporting json to {}".format(query.json_file))
-                query.export_to_json(objects_to_serialize)
-            else:
-                session.add_all(objects_to_serialize)
-                ctx.log(" ---> Inserting {} rows".format(len(list(session))))
-                session.commit()
+
+            inserted_rows = write_batches(
+                ctx, query, objects_generator, session, loader
+            )
+
+            if not using_cache and query.fetched_count != count:
+                ctx.log(" ---> Fetched {} objects".format(query.fetched_count))
+            if not ctx.export_json:
+                ctx.log(" ---> Inserting {} rows".format(inserted_rows))
 
         else:
             ctx.log(" ---> Nothing to do")
@@ -132,16 +301,328 @@ def copy_query(ctx, query, session, query_index, number_of_queries):
 def load_data(ctx):
     with db_profiling(ctx):
         with ctx.dest_db.no_fkc_session() as session:
+            if use_plan(ctx):
+                loader = get_loader(session, ctx.dest_db.metadata, get_loader_name(ctx))
+                plan = plan_queries(ctx)
+                copy_plan(ctx, plan, session, loader)
+                return
+
+            # Skip the rows already loaded by the previous queries
+            index = PrimaryKeyIndex()
+            loader = get_loader(
+                session, ctx.dest_db.metadata, get_loader_name(ctx), index
+            )
             raw_queries = get_raw_queries(ctx)
             number_of_queries = len(raw_queries)
-            for query_index, dict_query in enumerate(raw_queries):
-                query = parse_query(dict_query.copy(), ctx.src_db.session, ctx.config)
-                copy_query(ctx, query, session, query_index, number_of_queries)
+            executor = None
+            if ctx.interactive:
+                # Do not fetch anything before the user confirms each query
+                fetched_queries = (
+                    (parse_query(q.copy(), ctx.src_db.session, ctx.config), None)
+                    for q in raw_queries
+                )
+            else:
+                executor = PipelinedExecutor(
+                    ctx, raw_queries, get_jobs(ctx), get_queue_depth(ctx)
+                )
+                fetched_queries = executor
+            for query_index, (query, fetched) in enumerate(fetched_queries):
+                copy_query(
+                    ctx,
+                    query,
+                    session,
+                    loader,
+                    query_index,
+                    number_of_queries,
+                    fetched=fetched,
+                )
+            if not ctx.export_json:
+                report_primary_key_index(ctx, index)
+            if executor is not None:
+                executor.report()
+
+
+def report_primary_key_index(ctx, index):
+    ctx.log("", quietable=True)
+    ctx.log(
+        " ---> %d rows already loaded by previous queries were skipped"
+        % sum(index.hits.values()),
+        quietable=True,
+    )
+    ctx.log("", quietable=True)
+    rows = [(name, index.misses[name], index.hits[name]) for name in index.keys]
+    ctx.log(
+        tabulate(rows, headers=["Table", "Loaded", "Skipped"]),
+        prefix="    ",
+        quietable=True,
+    )
 
 
-def sync_schema(ctx):
+def plan_queries(ctx):
+    plan = ExtractionPlan(ctx.src_db, ctx.config["temp_table_threshold"])
+    raw_queries = get_raw_queries(ctx)
+    number_of_queries = len(raw_queries)
+    for query_index, raw_query in enumerate(raw_queries):
+        query = parse_query(raw_query.copy(), ctx.src_db.session, ctx.config)
+        ctx.log("")
+        ctx.log("Query %d/%d : " % ((query_index + 1), number_of_queries), nl=False)
+        ctx.log("")
+        ctx.log("")
+        ctx.log(dump_yaml(query.query_dict), prefix="    ")
+        ctx.log("", quietable=True)
+        ctx.log(
+            query.relation_tree.render(return_value=True),
+            tty_truncate=True,
+            quietable=True,
+        )
+        ctx.log(" ---> Planning {} rows".format(plan.add_query(query)))
+    return plan
+
+
+def copy_plan(ctx, plan, session, loader):
+    batch_size = get_batch_size(ctx)
+    tables = [t for t in loader.sorted_tables if plan.count(t.name)]
+
+    ctx.log("")
+    ctx.log("Extraction plan : %d rows from %d tables" % (plan.count(), len(tables)))
+    ctx.log("")
+    ctx.log(
+        tabulate(
+            [(t.name, plan.count(t.name)) for t in tables], headers=["Table", "Rows"]
+        ),
+        prefix="    ",
+        quietable=True,
+    )
+    ctx.log("", quietable=True)
+
+    continue_operation = True
+    if ctx.interactive:
+        continue_operation = ctx.continue_operation("Continue ?", default=False)
+    if not continue_operation:
+        ctx.log(" ---> Skipped")
+        return
+
+    inserted_rows = 0
+    with tqdm(total=plan.count(), leave=False) as progressbar:
+        for table in tables:
+            for rows in plan.iter_rows(table.name, batch_size):
+                inserted_rows += loader.load({table.name: rows})
+                session.commit()
+                progressbar.update(len(rows))
+    ctx.log(" ---> Inserting {} rows".format(inserted_rows))
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class PipelinedExecutor(object):
+    """Overlap the fetch of the queries with the insertion of their objects.
+
+    The fetch stage runs in ``jobs`` worker threads, each one with its own
+    source session. The batches of objects of every query are pushed into a
+    queue of at most ``queue_depth`` batches which is drained by the insert
+    stage (the consumer of the executor) in the order of the queries.
+
+    At most ``jobs + 1`` queries are in flight, so that the next queries are
+    fetched while the current one is being inserted without keeping more
+    than ``(jobs + 1) * queue_depth`` batches in memory.
+
+    Queries with the same cache key take its cache lock in their order: a
+    query waiting for the lock held by a next one, itself blocked on its full
+    queue, would never be inserted.
+    """
+
+    _END = object()
+
+    def __init__(self, ctx, raw_queries, jobs=1, queue_depth=2):
+        self.ctx = ctx
+        self.raw_queries = list(raw_queries)
+        self.jobs = jobs
+        self.queue_depth = queue_depth
+        self.queues = [Queue(maxsize=queue_depth) for _ in self.raw_queries]
+        self.slots = threading.Semaphore(jobs + 1)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.cache_keys = [None] * len(self.raw_queries)
+        self.locked = set()
+        self.lock_turns = threading.Condition()
+        self.stats = {
+            "fetch_busy": 0.0,
+            "fetch_blocked": 0.0,
+            "insert_busy": 0.0,
+            "insert_starved": 0.0,
+            "wall": 0.0,
+        }
+
+    def __iter__(self):
+        # Make sure mappers are configured before using them from threads
+        configure_mappers()
+        start = time.perf_counter()
+        workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(min(self.jobs, len(self.raw_queries)))
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for index in range(len(self.raw_queries)):
+                query, count, using_cache = self._get(index)
+                objects_generator = self._iter_batches(index)
+                consumed_at = time.perf_counter()
+                yield query, (objects_generator, count, using_cache)
+                self._add_stat("insert_busy", time.perf_counter() - consumed_at)
+                # Drain skipped or partially consumed queries
+                for _ in objects_generator:
+                    pass
+                self.slots.release()
+        finally:
+            self.stopped.set()
+            self.stats["wall"] = time.perf_counter() - start
+
+    def _iter_batches(self, index):
+        while True:
+            item = self._get(index)
+            if item is self._END:
+                return
+            yield item
+
+    def _get(self, index):
+        started_at = time.perf_counter()
+        item = self.queues[index].get()
+        waited = time.perf_counter() - started_at
+        self._add_stat("insert_starved", waited)
+        self._add_stat("insert_busy", -waited)
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def _put(self, index, item):
+        started_at = time.perf_counter()
+        while True:
+            if self.stopped.is_set():
+                raise PipelineAborted()
+            try:
+                self.queues[index].put(item, timeout=0.1)
+                break
+            except Full:
+                continue
+        self._add_stat("fetch_blocked", time.perf_counter() - started_at)
+
+    def _add_stat(self, name, value):
+        with self.lock:
+            self.stats[name] += value
+
+    def _work(self):
+        while not self.stopped.is_set():
+            while not self.slots.acquire(timeout=0.1):
+                if self.stopped.is_set():
+                    return
+            with self.lock:
+                index = self.next_index
+                self.next_index += 1
+            if index >= len(self.raw_queries):
+                self.slots.release()
+                return
+            try:
+                self._fetch(index)
+            except PipelineAborted:
+                return
+
+    def _wait_lock_turn(self, index, cache_key):
+        """Wait until the previous queries with ``cache_key`` have taken their
+        cache lock (the queries not parsed yet may have the same key)."""
+        with self.lock_turns:
+            self.cache_keys[index] = cache_key
+            self.lock_turns.notify_all()
+            while any(
+                i not in self.locked and self.cache_keys[i] in (None, cache_key)
+                for i in range(index)
+            ):
+                if self.stopped.is_set():
+                    raise PipelineAborted()
+                self.lock_turns.wait(0.1)
+
+    def _end_lock_turn(self, index):
+        with self.lock_turns:
+            self.locked.add(index)
+            self.lock_turns.notify_all()
+
+    def _fetch(self, index):
+        ctx = self.ctx
+        objects_generator = None
+        try:
+            started_at = time.perf_counter()
+            query = parse_query(
+                self.raw_queries[index].copy(), ctx.src_db.session, ctx.config
+            )
+            if not ctx.no_cache:
+                self._wait_lock_turn(index, query.cache_key)
+            try:
+                objects_generator, count, using_cache = get_objects_generator(
+                    ctx, query, ctx.src_db.session()
+                )
+            finally:
+                self._end_lock_turn(index)
+            self._add_stat("fetch_busy", time.perf_counter() - started_at)
+            self._put(index, (query, count, using_cache))
+            while True:
+                started_at = time.perf_counter()
+                batch = next(objects_generator, self._END)
+                self._add_stat("fetch_busy", time.perf_counter() - started_at)
+                self._put(index, batch)
+                if batch is self._END:
+                    break
+        except PipelineAborted:
+            raise
+        except Exception as exc:
+            self._put(index, exc)
+        finally:
+            self._end_lock_turn(index)
+            if objects_generator is not None:
+                objects_generator.close()
+            # Release the connection from the worker thread
+            ctx.src_db.session.remove()
+
+    def report(self):
+        wall = self.stats["wall"] or 1.0
+        ctx = self.ctx
+        ctx.log("", quietable=True)
+        ctx.log(" ---> Pipeline stages utilisation", quietable=True)
+        ctx.log("", quietable=True)
+        rows = [
+            (
+                "fetch (%d worker%s)" % (self.jobs, "s" if self.jobs > 1 else ""),
+                "%.1f%%" % (100 * self.stats["fetch_busy"] / (wall * self.jobs)),
+                "%.2fs blocked on full queues" % self.stats["fetch_blocked"],
+            ),
+            (
+                "insert",
+                "%.1f%%" % (100 * self.stats["insert_busy"] / wall),
+                "%.2fs waiting for batches" % self.stats["insert_starved"],
+            ),
+        ]
+        ctx.log(
+            tabulate(rows, headers=["Stage", "Busy", "Waits"]),
+            prefix="    ",
+            quietable=True,
+        )
+        ctx.log("Total time : %.2fs" % wall, prefix="    ", quietable=True)
+
+
+def reflect_schema(ctx):
     ctx.log(" ---> Reflecting database schema from %s" % repr(ctx.src_db_uri))
     ctx.src_db.reflect()
+    if ctx.src_db.changed_tables:
+        ctx.log(
+            " ---> Schema changed, reflected again : %s"
+            % ", ".join(ctx.src_db.changed_tables)
+        )
+
+
+def sync_schema(ctx):
+    reflect_schema(ctx)
     if not database_exists(ctx.dest_db_uri):
         create_db(ctx)
     create_tables(ctx)
@@ -167,8 +648,7 @@ def flush(ctx):
         ctx.log(" ---> Removing %s database" % repr(ctx.dest_db_uri))
         drop_database(ctx.dest_db_uri)
     create_db(ctx)
-    ctx.log(" ---> Reflecting database schema from %s" % repr(ctx.src_db_uri))
-    ctx.src_db.reflect()
+    reflect_schema(ctx)
     create_tables(ctx, checkfirst=False)
 
 
@@ -182,9 +662,173 @@ def clear(ctx):
 
 
 def load(ctx):
+    if ctx.export_json and use_plan(ctx):
+        raise click.UsageError("JSON export is not available with --plan")
     sync_schema(ctx)
-    with silent_sqlalchemy_warnings():
-        load_data(ctx)
+    try:
+        with silent_sqlalchemy_warnings():
+            load_data(ctx)
+    finally:
+        close_cache(ctx)
+
+
+def close_cache(ctx):
+    """Save the relation plans and the counters of the cache and evict the
+    least recently used queries if the cache is larger than
+    ``cache_max_size``."""
+    if ctx.no_cache or not ctx.config["cache"]:
+        return
+    ctx.src_db.relation_plans.save()
+    stats = ctx.src_db.cache_stats
+    max_size = parse_size(ctx.config["cache_max_size"])
+    if max_size is not None:
+        evicted = evict_cache(ctx.src_db.cache_manifest, max_size)
+        if evicted:
+            stats.incr("evictions", len(evicted))
+            ctx.log(
+                " ---> Evicted {} cached queries ({:.1f} MB)".format(
+                    len(evicted), sum(e.size for e in evicted) / (1024 * 1024.0)
+                ),
+                quietable=True,
+            )
+    stats.save()
+
+
+def get_cache_status(query, max_age=None, force_refresh=False):
+    """Return ``cached``, ``missing`` or ``stale`` (cached with another schema
+    or more than ``max_age`` seconds ago) for ``query``."""
+    entry = query.cache_entry
+    if entry is None:
+        if query.session.db.cache_manifest.get(query.cache_file) is not None:
+            return "stale"
+        return "missing"
+    if force_refresh or (max_age is not None and time.time() - entry.created > max_age):
+        return "stale"
+    return "cached"
+
+
+def warm_cache(ctx):
+    """Fetch the missing and stale queries into the cache, ``jobs`` queries at
+    once, without the destination database."""
+    if not ctx.config["cache"]:
+        raise click.UsageError("The cache is disabled (no cache directory)")
+    max_age = parse_duration(ctx.max_age)
+    reflect_schema(ctx)
+    # Make sure mappers are configured before using them from threads
+    configure_mappers()
+    # the objects are only cached, their count is not needed
+    ctx.count = "none"
+
+    raw_queries = get_raw_queries(ctx)
+    jobs = min(get_jobs(ctx), len(raw_queries)) or 1
+    results = [None] * len(raw_queries)
+    failures = []
+    lock = threading.Lock()
+    next_index = [0]
+
+    def warm(index):
+        started_at = time.perf_counter()
+        name = raw_queries[index]["from"]
+        query = None
+        try:
+            query = parse_query(
+                raw_queries[index].copy(), ctx.src_db.session, ctx.config
+            )
+            prepare_query(ctx, query)
+            status = get_cache_status(query, max_age, ctx.force_refresh)
+            count = None
+            result = None
+            if (
+                ctx.incremental_refresh
+                and not ctx.force_refresh
+                and (status == "stale" or max_age is None)
+                and query.cache_entry is not None
+            ):
+                result = refresh_cached_query(ctx, query)
+            if result is not None:
+                status = "updated ({} rows, {} deleted)".format(*result)
+                count = query.cache_entry.count
+            elif status == "cached":
+                count = query.cache_entry.count
+            else:
+                objects_generator, _, using_cache = get_objects_generator(
+                    ctx, query, ctx.src_db.session(), refresh=status == "stale"
+                )
+                with closing(objects_generator):
+                    if using_cache:
+                        # cached by another thread or process in the meantime
+                        status, count = "cached", query.cache_entry.count
+                    else:
+                        for _ in objects_generator:
+                            pass
+                        count = query.fetched_count
+                        status = "refreshed" if status == "stale" else "fetched"
+        except Exception as exc:
+            status, count = "failed", None
+            with lock:
+                failures.append((index, exc))
+        finally:
+            ctx.src_db.session.remove()
+        elapsed = time.perf_counter() - started_at
+        results[index] = (
+            index + 1,
+            name,
+            query.cache_key[:12] if query is not None else "",
+            status,
+            count,
+            elapsed,
+        )
+        ctx.log(
+            " ---> Query %d/%d (%s) : %s in %.2fs"
+            % (index + 1, len(raw_queries), name, status, elapsed),
+            quietable=True,
+        )
+
+    def work():
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= len(raw_queries):
+                return
+            warm(index)
+
+    ctx.log(
+        " ---> Warming the cache with %d queries (%d worker%s)"
+        % (len(raw_queries), jobs, "s" if jobs > 1 else "")
+    )
+    started_at = time.perf_counter()
+    try:
+        with silent_sqlalchemy_warnings():
+            workers = [threading.Thread(target=work) for _ in range(jobs)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    finally:
+        close_cache(ctx)
+
+    ctx.log("")
+    ctx.log(
+        tabulate(
+            results,
+            headers=["#", "Query", "Cache key", "Status", "Objects", "Time (s)"],
+            floatfmt=".2f",
+            missingval="-",
+        ),
+        prefix="    ",
+    )
+    ctx.log("")
+    ctx.log("Total time : %.2fs" % (time.perf_counter() - started_at), prefix="    ")
+    for index, exc in failures:
+        ctx.log(
+            " ---> Query %d/%d (%s) failed : %s"
+            % (index + 1, len(raw_queries), raw_queries[index]["from"], exc)
+        )
+    if failures:
+        raise click.ClickException(
+            "%d/%d queries could not be cached" % (len(failures), len(raw_queries))
+        )
 
 
 def inspect_db(ctx):
@@ -222,14 +866,107 @@ def inspect_db(ctx):
     ctx.log(" ---> Cache ")
     ctx.log("")
     ctx.log("location : %s" % ctx.config["cache"], prefix="    ")
+    manifest = ctx.src_db.cache_manifest
+    entries = manifest.entries()
+    disk_usage = "Disk usage : %.1f MB" % (
+        manifest.disk_usage(entries) / (1024 * 1024.0)
+    )
+    if ctx.config["cache_max_size"] is not None:
+        disk_usage += " (max size : %s)" % ctx.config["cache_max_size"]
+    ctx.log(disk_usage, prefix="    ")
+    ctx.log(
+        "Queries : %d cached (%d objects, %d rows)"
+        % (
+            len(entries),
+            sum(entry.count for entry in entries),
+            sum(entry.rows for entry in entries),
+        ),
+        prefix="    ",
+    )
+    stats = ctx.src_db.cache_stats.totals()
+    queries = stats["hits"] + stats["misses"]
     ctx.log(
-        "Disk usage : %.1f MB" % get_directory_size(ctx.config["cache"]), prefix="    "
+        "Hits : %d / %d queries (%.1f%%)"
+        % (stats["hits"], queries, 100.0 * stats["hits"] / (queries or 1)),
+        prefix="    ",
     )
+    ctx.log(
+        "Rows : %d read from the cache, %d fetched"
+        % (stats["rows_hits"], stats["rows_misses"]),
+        prefix="    ",
+    )
+    ctx.log("Saved : %.1f MB" % (stats["bytes_saved"] / (1024 * 1024.0)), prefix="    ")
+    ctx.log("Evictions : %d" % stats["evictions"], prefix="    ")
+    ctx.log("")
+
+
+def bench_cache(ctx, codec_names=None, max_rows=None):
+    """Compress the cache of the source database with the compression codecs
+    and report their ratio and throughputs, relative to the uncompressed size.
+    """
+    db = ctx.src_db
+    codecs = [get_codec(name) for name in codec_names or CODECS]
+    payloads = dict((cache, []) for cache in CACHES)
+    for entry in db.cache_manifest.entries():
+        if os.path.dirname(os.path.abspath(entry.path)) != os.path.abspath(
+            db.cache_dir
+        ):
+            continue
+        with open(entry.path, "rb") as fd:
+            payloads["queries"].extend(ColumnarReader(fd).frames())
+    if os.path.exists(db.row_store_path):
+        payloads["rows"].extend(db.row_store.iter_encoded_rows(max_rows))
+    for path in (db.cached_metadata_path, db.cached_relation_plans_path):
+        if os.path.exists(path):
+            with open(path, "rb") as fd:
+                payloads["metadata"].append(read_compressed(fd))
+
+    rows = []
+    for cache in CACHES:
+        size = sum(len(payload) for payload in payloads[cache])
+        if not size:
+            continue
+        for codec in codecs:
+            compressed_size, write_time, read_time = benchmark_codec(
+                codec, payloads[cache]
+            )
+            rows.append(
+                (
+                    cache,
+                    codec.name,
+                    "%.2f" % (size / 1e6),
+                    "%.2f" % (compressed_size / 1e6),
+                    "%.2f" % (size / max(compressed_size, 1)),
+                    "%.1f" % (size / 1e6 / max(write_time, 1e-9)),
+                    "%.1f" % (size / 1e6 / max(read_time, 1e-9)),
+                )
+            )
+    if not rows:
+        ctx.log(" ---> The cache of %s is empty" % db.cache_dir)
+        return
+
+    headers = [
+        "Cache",
+        "Codec",
+        "Size (MB)",
+        "Compressed (MB)",
+        "Ratio",
+        "Write (MB/s)",
+        "Read (MB/s)",
+    ]
+    ctx.log(" ---> Cache compression (%s)" % db.cache_dir)
+    ctx.log("")
+    ctx.log(tabulate(rows, headers=headers), prefix="    ")
     ctx.log("")
 
 
 def purge_cache(ctx):
-    included_extensions = ["cache", "count"]
+    if ctx.config["cache"]:
+        entries = ctx.src_db.cache_manifest.purge()
+        ctx.log(" ---> Purged {} cached queries".format(len(entries)), quietable=True)
+
+    # row stores, cached schemas, locks and unfinished writes
+    included_extensions = ["cache", "count", "lock", "tmp"]
 
     def listfiles(path):
         for r, d, f in os.walk(path):
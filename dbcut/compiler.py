@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from sqlalchemy.dialects import mysql
 from sqlalchemy.ext.compiler import compiles
-from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.expression import ClauseElement, Executable, Insert
 
 
 @compiles(mysql.LONGBLOB, "sqlite")
@@ -76,3 +76,22 @@ def compile_insert_on_duplicate_ignore_mysql(element, compiler, **kw):
 @compiles(Insert, "sqlite")
 def compile_insert_on_duplicate_ignore_sqlite(element, compiler, **kw):
     return compiler.visit_insert(element.prefix_with("OR IGNORE"), **kw)
+
+
+class Explain(Executable, ClauseElement):
+    """``EXPLAIN`` of a statement, to read the estimates of the query planner."""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN %s" % compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, "postgresql")
+def compile_explain_postgresql(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) %s" % compiler.process(element.statement, **kw)
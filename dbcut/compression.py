@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Compression codecs of the cache files.
+
+Every codec compresses and decompresses ``bytes``. The standard library codecs
+(``zlib``, ``bz2`` and ``lzma``) are always available, ``lz4`` and ``zstd``
+only when the ``lz4`` and ``zstandard`` packages are installed.
+
+The codec of each cache (see ``CACHES``) is chosen with the
+``cache_compression`` option. The name of the codec is written along with the
+compressed data so that the caches written with another codec are still read.
+"""
+import bz2
+import lzma
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = [
+    "CACHES",
+    "CODECS",
+    "Codec",
+    "benchmark_codec",
+    "get_cache_codecs",
+    "get_codec",
+    "read_compressed",
+    "write_compressed",
+]
+
+# Caches of the cache directory: the cache files of the queries (keys of
+# their rows), the row store and the reflected schema (metadata and relation
+# plans).
+CACHES = ("queries", "rows", "metadata")
+
+COMPRESSED_MAGIC = b"DBCUT-COMPRESSED:"
+
+Codec = namedtuple("Codec", ["name", "compress", "decompress"])
+
+CODECS = OrderedDict()
+
+
+def register_codec(name, compress, decompress):
+    CODECS[name] = Codec(name, compress, decompress)
+
+
+def _identity(data):
+    return data
+
+
+register_codec("none", _identity, _identity)
+register_codec("zlib", zlib.compress, zlib.decompress)
+register_codec("bz2", bz2.compress, bz2.decompress)
+register_codec("lzma", lzma.compress, lzma.decompress)
+
+if lz4_frame is not None:
+    register_codec("lz4", lz4_frame.compress, lz4_frame.decompress)
+
+if zstandard is not None:
+    register_codec(
+        "zstd",
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def get_codec(name):
+    if name is None:
+        name = "none"
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+            "Unknown compression codec %r (available codecs: %s)"
+            % (name, ", ".join(CODECS))
+        )
+
+
+def get_cache_codecs(option=None):
+    """Return the codec of each cache from the ``cache_compression`` option,
+    either the name of the codec of every cache or a mapping of cache names
+    to codec names (``none`` for the missing caches).
+    """
+    if not isinstance(option, dict):
+        option = dict((cache, option) for cache in CACHES)
+    unknown = set(option) - set(CACHES)
+    if unknown:
+        raise ValueError(
+            "Unknown cache %r in cache_compression (caches: %s)"
+            % (sorted(unknown)[0], ", ".join(CACHES))
+        )
+    return dict((cache, get_codec(option.get(cache))) for cache in CACHES)
+
+
+def write_compressed(fd, data, codec):
+    """Write ``data`` compressed with ``codec`` to the file ``fd``."""
+    fd.write(COMPRESSED_MAGIC + codec.name.encode("ascii") + b"\n")
+    fd.write(codec.compress(data))
+
+
+def read_compressed(fd):
+    """Read the data written by ``write_compressed``, files written without
+    compression being read as is."""
+    data = fd.read()
+    if not data.startswith(COMPRESSED_MAGIC):
+        return data
+    header, _, data = data.partition(b"\n")
+    return get_codec(header[len(COMPRESSED_MAGIC) :].decode("ascii")).decompress(data)
+
+
+def benchmark_codec(codec, payloads):
+    """Compress and decompress ``payloads`` with ``codec`` and return the
+    compressed size and the compression and decompression times."""
+    start = time.perf_counter()
+    compressed = [codec.compress(payload) for payload in payloads]
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in compressed:
+        codec.decompress(payload)
+    read_time = time.perf_counter() - start
+    return sum(len(payload) for payload in compressed), write_time, read_time
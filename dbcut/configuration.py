@@ -23,6 +23,18 @@ DEFAULT_CONFIG = {
     "default_backref_depth": 2,
     "default_join_depth": 5,
     "global_exclude": [],
+    "batch_size": None,
+    "loader": "native",
+    "jobs": 1,
+    "queue_depth": 2,
+    "plan": False,
+    "engine": "orm",
+    "temp_table_threshold": 5000,
+    "count": "estimate",
+    "cache_compression": "none",
+    "cache_max_size": None,
+    "change_tracking_columns": ["updated_at", "modified"],
+    "soft_delete_column": None,
 }
 
 
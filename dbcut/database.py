@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import hashlib
 import os
 import pickle
 import re
@@ -9,19 +10,25 @@ import threading
 from contextlib import contextmanager
 
 import sqlalchemy
-from sqlalchemy import MetaData, Table, create_engine, event, func, inspect
+from sqlalchemy import MetaData, Table, create_engine, event, func, inspect, text
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.automap import automap_base, generate_relationship
 from sqlalchemy.schema import conv
 from sqlalchemy.sql.expression import select
 from sqlalchemy.types import Text
 
 from . import SQLALCHEMY_VERSION, VERSION
+from .cache import RowStore
+from .compression import get_cache_codecs, read_compressed, write_compressed
 from .configuration import DEFAULT_CONFIG
+from .graph import RelationPlanCache, SchemaGraph
+from .manifest import CacheManifest, CacheStats
 from .models import BaseDeclarativeMeta, BaseModel
 from .query import BaseQuery, QueryProperty
+from .serializer import to_json
 from .session import SessionProperty
-from .utils import (aslist, cached_property, create_directory,
+from .utils import (AtomicFile, aslist, cached_property, create_directory,
                     generate_valid_index_name, to_unicode)
 
 try:
@@ -34,9 +41,74 @@ except ImportError:
 
 _MYSQL_LENGHT_TEXT_INDEX_COLUMN = 128
 
+# Definitions of the columns, constraints and indexes of the tables of the
+# database, as (table name, definition) rows (see ``Database.get_schema_state``)
+_SCHEMA_STATE_QUERIES = {
+    "sqlite": """
+        SELECT tbl_name, sql
+        FROM sqlite_master
+        WHERE type IN ('table', 'index')
+        AND sql IS NOT NULL
+        AND tbl_name NOT LIKE 'sqlite~_%' ESCAPE '~'
+    """,
+    "postgresql": """
+        SELECT c.relname, a.attnum || ' ' || a.attname || ' '
+            || pg_catalog.format_type(a.atttypid, a.atttypmod) || ' '
+            || a.attnotnull::text || ' '
+            || COALESCE(pg_catalog.pg_get_expr(d.adbin, d.adrelid), '')
+        FROM pg_catalog.pg_attribute a
+        JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        LEFT JOIN pg_catalog.pg_attrdef d
+            ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+        WHERE c.relkind IN ('r', 'p') AND n.nspname = current_schema()
+        AND a.attnum > 0 AND NOT a.attisdropped
+        UNION ALL
+        SELECT c.relname, o.conname || ' ' || pg_catalog.pg_get_constraintdef(o.oid)
+        FROM pg_catalog.pg_constraint o
+        JOIN pg_catalog.pg_class c ON c.oid = o.conrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relkind IN ('r', 'p') AND n.nspname = current_schema()
+        UNION ALL
+        SELECT tablename, indexdef
+        FROM pg_catalog.pg_indexes
+        WHERE schemaname = current_schema()
+    """,
+    "mysql": """
+        SELECT c.table_name, CONCAT_WS(' ', c.ordinal_position, c.column_name,
+            c.column_type, c.is_nullable, c.column_default, c.extra)
+        FROM information_schema.columns c
+        JOIN information_schema.tables t
+            ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+        WHERE c.table_schema = DATABASE() AND t.table_type = 'BASE TABLE'
+        UNION ALL
+        SELECT table_name, CONCAT_WS(' ', constraint_name, ordinal_position,
+            column_name, referenced_table_name, referenced_column_name)
+        FROM information_schema.key_column_usage
+        WHERE table_schema = DATABASE()
+        UNION ALL
+        SELECT table_name, CONCAT_WS(' ', index_name, non_unique, seq_in_index,
+            column_name)
+        FROM information_schema.statistics
+        WHERE table_schema = DATABASE()
+    """,
+}
+
 __all__ = ["Database"]
 
 
+def describe_columns(table):
+    return sorted(
+        [
+            column.name,
+            type(column.type).__name__,
+            column.nullable,
+            column.primary_key,
+        ]
+        for column in table.columns
+    )
+
+
 class Database(object):
     """This class is used to instantiate a SQLAlchemy connection to
     a database.
@@ -54,6 +126,9 @@ class Database(object):
         echo_sql=False,
         echo_stream=None,
         metadata=None,
+        cache_compression=None,
+        change_tracking_columns=None,
+        soft_delete_column=None,
     ):
         self.connector = None
         self._reflected = False
@@ -63,26 +138,33 @@ class Database(object):
         self.uri = make_url(uri)
         self.enable_cache = enable_cache
         self.global_cache_dir = cache_dir or DEFAULT_CONFIG["cache"]
+        self.cache_codecs = get_cache_codecs(
+            cache_compression or DEFAULT_CONFIG["cache_compression"]
+        )
+        if change_tracking_columns is None:
+            change_tracking_columns = DEFAULT_CONFIG["change_tracking_columns"]
+        self.change_tracking_columns = tuple(change_tracking_columns or ())
+        self.soft_delete_column = soft_delete_column
         self._session_options = dict(session_options or {})
         self._session_options.setdefault("autoflush", False)
         self._session_options.setdefault("autocommit", False)
         self._engine_lock = threading.Lock()
         self._model_class_registry = {}
+        self._schema_graph = None
+        self._schema_fingerprint = None
+        self._relation_plans = None
+        self._row_store = None
+        self._schema_lock = threading.Lock()
         self.profiler = SessionProfiler(engine=self.engine)
+        self.changed_tables = []
 
-        if self.enable_cache and self.cached_metadata:
-            metadata = metadata or self.cached_metadata
+        self._cached_schema_state = None
+        self._metadata_from_cache = False
+        if self.enable_cache and metadata is None:
+            self._cached_schema_state, metadata = self.cached_schema
+            self._metadata_from_cache = metadata is not None
 
-        self.Model = automap_base(
-            cls=type("BaseModel", (BaseModel,), {}),
-            name="Model",
-            metaclass=BaseDeclarativeMeta,
-            metadata=metadata,
-        )
-
-        self.Model._db = self
-        self.Model._session = SessionProperty(self)
-        self.Model._query = QueryProperty(self)
+        self._create_model(metadata)
 
         event.listen(self.engine, "before_cursor_execute", self._before_custor_execute)
         event.listen(self.engine, "after_cursor_execute", self._after_custor_execute)
@@ -127,21 +209,129 @@ class Database(object):
         """Proxy for Model.metadata"""
         return self.Model.metadata
 
+    def _create_model(self, metadata=None):
+        self.Model = automap_base(
+            cls=type("BaseModel", (BaseModel,), {}),
+            name="Model",
+            metaclass=BaseDeclarativeMeta,
+            metadata=metadata,
+        )
+
+        self.Model._db = self
+        self.Model._session = SessionProperty(self)
+        self.Model._query = QueryProperty(self)
+
     @property
-    def cached_metadata(self):
-        _cached_metadata = None
+    def cached_schema(self):
+        """Return the cached state of the schema (see ``get_schema_state``) and
+        metadata, or ``(None, None)``."""
         if os.path.exists(self.cached_metadata_path):
             try:
                 with open(os.path.join(self.cached_metadata_path), "rb") as cache_file:
-                    _cached_metadata = pickle.load(file=cache_file)
+                    cached = pickle.loads(read_compressed(cache_file))
             except IOError:
                 pass
-        return _cached_metadata
+            else:
+                if isinstance(cached, MetaData):
+                    # cached without the state of the schema
+                    return None, cached
+                return cached
+        return None, None
+
+    @property
+    def cached_metadata(self):
+        return self.cached_schema[1]
 
     @property
     def cached_metadata_path(self):
         return os.path.join(self.cache_dir, "metadata.cache")
 
+    @property
+    def schema_graph(self):
+        """Relationships index of the reflected models, built on first use."""
+        with self._schema_lock:
+            if self._schema_graph is None:
+                self._schema_graph = SchemaGraph(self.models)
+            return self._schema_graph
+
+    @property
+    def schema_fingerprint(self):
+        """Hash of the tables and columns of the reflected metadata."""
+        with self._schema_lock:
+            if self._schema_fingerprint is None:
+                tables = sorted(
+                    [table.name, describe_columns(table)]
+                    for table in self.tables.values()
+                )
+                self._schema_fingerprint = hashlib.sha1(
+                    to_json(tables).encode("utf-8")
+                ).hexdigest()
+            return self._schema_fingerprint
+
+    @property
+    def table_fingerprints(self):
+        """Hash of the columns of each table of the reflected metadata, by
+        table name."""
+        return dict(
+            (
+                name,
+                hashlib.sha1(
+                    to_json(describe_columns(table)).encode("utf-8")
+                ).hexdigest(),
+            )
+            for name, table in self.tables.items()
+        )
+
+    @property
+    def relation_plans(self):
+        """Relation plans of the parsed queries, saved in the cache directory."""
+        graph = self.schema_graph
+        with self._schema_lock:
+            if self._relation_plans is None or self._relation_plans.graph is not graph:
+                path = self.cached_relation_plans_path if self.enable_cache else None
+                self._relation_plans = RelationPlanCache(
+                    graph, path, self.cache_codecs["metadata"]
+                )
+            return self._relation_plans
+
+    @property
+    def cached_relation_plans_path(self):
+        return os.path.join(self.cache_dir, "relations.cache")
+
+    @property
+    def row_store(self):
+        """Rows of the cached queries, stored once per table and key."""
+        with self._schema_lock:
+            if self._row_store is None:
+                self._row_store = RowStore(
+                    self.row_store_path, self.cache_codecs["rows"], self.cache_stats
+                )
+                # rows stored with another definition of their table are stale
+                self._row_store.invalidate(self.table_fingerprints)
+            return self._row_store
+
+    @property
+    def row_store_path(self):
+        return os.path.join(self.cache_dir, "rows.cache")
+
+    def get_tracking_column(self, table):
+        """Return the change-tracking column of ``table``, its first column
+        named in ``change_tracking_columns``, or ``None``."""
+        for name in self.change_tracking_columns:
+            if name in table.columns:
+                return table.columns[name]
+
+    @cached_property
+    def cache_manifest(self):
+        """Index of the cached queries, at the root of the cache."""
+        create_directory(self.global_cache_dir)
+        return CacheManifest(self.global_cache_dir)
+
+    @cached_property
+    def cache_stats(self):
+        """Hit and miss counters of the cache, saved in its manifest."""
+        return CacheStats(self.cache_manifest)
+
     @property
     def query(self):
         """Proxy for session.query"""
@@ -163,14 +353,75 @@ class Database(object):
         """Proxy for session.rollback"""
         return self.session.rollback()
 
+    def get_schema_state(self):
+        """Return a hash of the definition of each table of the database (its
+        columns, constraints and indexes) by table name, read with a single
+        query, or ``None`` if the dialect is not supported."""
+        query = _SCHEMA_STATE_QUERIES.get(self.engine.dialect.name)
+        if query is None:
+            return None
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(text(query)).fetchall()
+        except DBAPIError:
+            return None
+        definitions = {}
+        for table_name, definition in rows:
+            definitions.setdefault(table_name, []).append(to_unicode(definition or ""))
+        return dict(
+            (
+                table_name,
+                hashlib.sha1("\n".join(sorted(lines)).encode("utf-8")).hexdigest(),
+            )
+            for table_name, lines in definitions.items()
+        )
+
+    def patch_metadata(self, metadata, table_names, bind):
+        """Return a copy of ``metadata`` in which the tables ``table_names`` are
+        reflected again, or removed if they do not exist anymore."""
+        patched = MetaData()
+        for table in metadata.tables.values():
+            if table.name not in table_names:
+                if SQLALCHEMY_VERSION >= "1.4.0":
+                    table.to_metadata(patched)
+                else:
+                    table.tometadata(patched)
+        patched.reflect(bind, only=lambda name, _: name in table_names)
+        return patched
+
     def reflect(self, bind=None):
-        """Reflect metadata from database"""
+        """Reflect metadata from database.
+
+        The reflected metadata is cached along with the state of the schema
+        (see ``get_schema_state``). The cached metadata is used as long as
+        the state of the schema is the same, only the tables whose state has
+        changed (listed in ``changed_tables``) being reflected again.
+        """
         if not self._reflected:
             reflect = True
             if bind is None:
                 bind = self.engine
-            if self.enable_cache and self.cached_metadata:
-                reflect = False
+            schema_state = None
+            if self.enable_cache:
+                schema_state = self.get_schema_state()
+            write_cache = self.enable_cache
+            if self._metadata_from_cache:
+                cached_state = self._cached_schema_state
+                if schema_state is None or schema_state == cached_state:
+                    reflect = write_cache = False
+                elif cached_state is None:
+                    # cached without the state of the schema, reflect it again
+                    self._create_model()
+                else:
+                    self.changed_tables = sorted(
+                        name
+                        for name in set(cached_state) | set(schema_state)
+                        if cached_state.get(name) != schema_state.get(name)
+                    )
+                    self._create_model(
+                        self.patch_metadata(self.metadata, self.changed_tables, bind)
+                    )
+                    reflect = False
 
             self.Model.prepare(
                 bind,
@@ -204,10 +455,17 @@ class Database(object):
                     if mysql_length:
                         index.kwargs["mysql_length"] = mysql_length
 
-            if self.enable_cache and not self.cached_metadata:
-                with open(os.path.join(self.cached_metadata_path), "wb") as cache_file:
-                    pickle.dump(self.metadata, cache_file)
+            if write_cache:
+                with AtomicFile(self.cached_metadata_path) as cache_file:
+                    write_compressed(
+                        cache_file,
+                        pickle.dumps((schema_state, self.metadata)),
+                        self.cache_codecs["metadata"],
+                    )
+                self._cached_schema_state = schema_state
 
+            self._schema_graph = None
+            self._schema_fingerprint = None
             self._reflected = True
 
     def prepare(self, bind=None):
@@ -216,6 +474,8 @@ class Database(object):
             if bind is None:
                 bind = self.engine
             self.Model.prepare(bind)
+            self._schema_graph = None
+            self._schema_fingerprint = None
             self._prepared = True
 
     def get_all_indexes(self):
@@ -247,6 +507,12 @@ class Database(object):
     def close(self, **kwargs):
         """Proxy for Session.close"""
         self.session.close()
+        if self._relation_plans is not None:
+            self._relation_plans.save()
+        if self._row_store is not None:
+            self._row_store.close()
+        if "cache_manifest" in getattr(self, "_cache", {}):
+            self.cache_manifest.close()
         with self._engine_lock:
             if self.connector is not None:
                 self.connector.get_engine().dispose()
@@ -0,0 +1,481 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+from collections import OrderedDict, deque
+
+from sqlalchemy import Column, MetaData, Table, and_, func, or_, select, tuple_
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import interfaces
+
+from . import SQLALCHEMY_VERSION
+from .compiler import Explain
+from .utils import rebatch
+
+__all__ = ["ENGINES", "ExtractionPlan", "RelationWalker", "RowBatch"]
+
+# Extraction engines: ORM objects graphs, or plain rows fetched with Core
+ENGINES = ("orm", "core")
+
+# Number of keys sent per ``IN`` list, the same as ``selectinload``
+IN_CHUNK_SIZE = 500
+
+
+def get_key_columns(table):
+    """Columns identifying a row of ``table``: its primary key, or all its
+    columns when it has none.
+    """
+    return list(table.primary_key.columns) or list(table.columns)
+
+
+def get_row_key(table, row):
+    return tuple(row.get(c.key) for c in get_key_columns(table))
+
+
+def get_relationship_pairs(relationship):
+    """Pairs of ``(parent column, child column)`` joining the rows of the
+    parent of ``relationship`` to its target rows, through the association
+    table for many-to-many relationships.
+    """
+    if relationship.direction is interfaces.MANYTOMANY:
+        return [
+            relationship.synchronize_pairs,
+            [(s, c) for c, s in relationship.secondary_synchronize_pairs],
+        ]
+    return [relationship.local_remote_pairs]
+
+
+def in_clause(columns, values):
+    """Build a ``columns IN values`` criterion, ``values`` being tuples."""
+    if len(columns) == 1:
+        return columns[0].in_([value[0] for value in values])
+    return or_(*(and_(*(c == v for c, v in zip(columns, value))) for value in values))
+
+
+def keyset_criterion(columns, key):
+    """Criterion selecting the rows following ``key`` in the descending order
+    of ``columns``."""
+    criteria = []
+    for i, column in enumerate(columns):
+        previous = [c == v for c, v in zip(columns[:i], key)]
+        criteria.append(and_(*(previous + [column < key[i]])))
+    return or_(*criteria)
+
+
+def supports_window_functions(dialect):
+    if dialect.name == "sqlite":
+        return getattr(dialect.dbapi, "sqlite_version_info", (0,)) >= (3, 25)
+    if dialect.name == "mysql":
+        version = dialect.server_version_info or (0,)
+        if getattr(dialect, "is_mariadb", getattr(dialect, "_is_mariadb", False)):
+            return version >= (10, 2)
+        return version >= (8, 0)
+    return dialect.name in ("postgresql", "oracle", "mssql")
+
+
+def supports_row_count_estimate(dialect):
+    return dialect.name in ("postgresql", "mysql")
+
+
+def estimate_row_count(connection, statement):
+    """Return the number of rows of ``statement`` estimated by the query
+    planner of PostgreSQL or MySQL, or ``None`` if there is no estimate.
+    """
+    dialect = connection.dialect.name
+    try:
+        if dialect == "postgresql":
+            with connection.begin_nested():
+                plan = connection.execute(Explain(statement)).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"])
+        elif dialect == "mysql":
+            result = connection.execute(Explain(statement))
+            row = dict(zip(result.keys(), result.first()))
+            if row.get("rows") is None:
+                return None
+            return int(row["rows"] * (row.get("filtered") or 100) / 100)
+    except DBAPIError:
+        pass
+    return None
+
+
+def limit_per_parent(table, parent_columns, criterion, limit, dialect):
+    """Build a criterion selecting the rows of ``table`` matching ``criterion``,
+    but only the first ``limit`` ones (by primary key) of each parent, given
+    by the values of ``parent_columns``.
+
+    Rows are ranked with ``ROW_NUMBER()`` where window functions are
+    supported, or by counting their preceding siblings otherwise.
+    """
+    pk_columns = get_key_columns(table)
+    if supports_window_functions(dialect):
+        rank = func.row_number().over(partition_by=parent_columns, order_by=pk_columns)
+        ranked = (
+            select(pk_columns + [rank.label("dbcut_rank")])
+            .where(criterion)
+            .correlate(None)
+            .alias("dbcut_ranked")
+        )
+        first_rows = select([ranked.c[c.key] for c in pk_columns]).where(
+            ranked.c.dbcut_rank <= limit
+        )
+        if len(pk_columns) == 1:
+            return pk_columns[0].in_(first_rows)
+        return tuple_(*pk_columns).in_(first_rows)
+
+    siblings = table.alias("dbcut_siblings")
+    preceding = select([func.count()]).where(
+        and_(
+            *[siblings.c[c.key] == c for c in parent_columns]
+            + [keyset_criterion([siblings.c[c.key] for c in pk_columns], pk_columns)]
+        )
+    )
+    if SQLALCHEMY_VERSION >= "1.4.0":
+        preceding = preceding.scalar_subquery()
+    else:
+        preceding = preceding.as_scalar()
+    return and_(criterion, preceding < limit)
+
+
+def chunked(values, size):
+    return rebatch([values], size)
+
+
+def sorted_keys(keys):
+    try:
+        return sorted(keys)
+    except TypeError:
+        return list(keys)
+
+
+_keys_table_ids = itertools.count()
+
+
+def create_keys_table(connection, columns, keys):
+    """Create a temporary table of the source database holding ``keys``, to
+    be joined on ``columns``.
+
+    Return ``None`` if the table cannot be created, for instance on a read
+    only replica.
+    """
+    keys_table = Table(
+        "dbcut_keys_%d" % next(_keys_table_ids),
+        MetaData(),
+        *(Column("k%d" % i, c.type) for i, c in enumerate(columns)),
+        prefixes=["TEMPORARY"]
+    )
+    try:
+        if connection.dialect.name == "postgresql":
+            # A failed statement aborts the whole transaction
+            with connection.begin_nested():
+                keys_table.create(connection)
+        else:
+            keys_table.create(connection)
+    except DBAPIError:
+        return None
+    for chunk in chunked(list(keys), IN_CHUNK_SIZE):
+        connection.execute(
+            keys_table.insert(),
+            [{"k%d" % i: v for i, v in enumerate(value)} for value in chunk],
+        )
+    return keys_table
+
+
+def iter_rows_by_keys(
+    session,
+    table,
+    columns,
+    key_columns,
+    keys,
+    limit=None,
+    temp_table_threshold=None,
+    criterion=None,
+):
+    """Fetch the ``columns`` of the rows of ``table`` whose ``key_columns``
+    values are in ``keys``, and yield them by lists of rows.
+
+    Keys are sent by ``IN`` lists of ``IN_CHUNK_SIZE`` keys, or stored in a
+    temporary table when there are more than ``temp_table_threshold`` of
+    them. With ``limit``, only the first ``limit`` rows of each key are
+    fetched (see ``limit_per_parent``). With ``criterion``, only the rows
+    matching it are fetched.
+    """
+    connection = session.connection()
+
+    def fetch(statement):
+        result = connection.execution_options(stream_results=True).execute(statement)
+        while True:
+            rows = result.fetchmany(IN_CHUNK_SIZE)
+            if not rows:
+                break
+            yield [OrderedDict(zip((c.key for c in columns), row)) for row in rows]
+
+    def filter_rows(keys_criterion):
+        if criterion is not None:
+            keys_criterion = and_(keys_criterion, criterion)
+        if limit:
+            keys_criterion = limit_per_parent(
+                table, key_columns, keys_criterion, limit, connection.dialect
+            )
+        return select(columns).where(keys_criterion)
+
+    keys_table = None
+    if temp_table_threshold and len(keys) > temp_table_threshold:
+        keys_table = create_keys_table(connection, key_columns, keys)
+
+    if keys_table is None:
+        for chunk in chunked(sorted_keys(keys), IN_CHUNK_SIZE):
+            yield from fetch(filter_rows(in_clause(key_columns, chunk)))
+        return
+
+    try:
+        if limit:
+            # Temporary tables can only be referenced once per statement on
+            # MySQL, and the ranking subquery references it
+            stored_keys = select(list(keys_table.columns))
+            if len(key_columns) == 1:
+                statement = filter_rows(key_columns[0].in_(stored_keys))
+            else:
+                statement = filter_rows(tuple_(*key_columns).in_(stored_keys))
+        else:
+            onclause = and_(
+                *(c == keys_table.c["k%d" % i] for i, c in enumerate(key_columns))
+            )
+            statement = select(columns).select_from(table.join(keys_table, onclause))
+            if criterion is not None:
+                statement = statement.where(criterion)
+        yield from fetch(statement)
+    finally:
+        keys_table.drop(connection)
+
+
+def fetch_rows_by_keys(
+    session, table, keys, temp_table_threshold=None, criterion=None, keys_only=False
+):
+    """Fetch the full rows of ``table`` whose key (see ``get_key_columns``) is
+    in ``keys`` and matching ``criterion``, if any, and return them by key.
+    With ``keys_only``, only the key columns of the rows are fetched."""
+    key_columns = get_key_columns(table)
+    rows = OrderedDict()
+    for batch in iter_rows_by_keys(
+        session,
+        table,
+        key_columns if keys_only else list(table.columns),
+        key_columns,
+        keys,
+        temp_table_threshold=temp_table_threshold,
+        criterion=criterion,
+    ):
+        for row in batch:
+            rows[get_row_key(table, row)] = row
+    return rows
+
+
+class RelationWalker(object):
+    """Fetch the rows of a query and of its relation tree as plain rows.
+
+    The relation tree is walked breadth-first with Core ``SELECT``
+    statements: the keys of the rows fetched for a node are propagated to its
+    children as ``IN`` lists, chunked and limited the same way as the
+    ``selectinload`` and ``joinedload`` options of the ORM query
+    (``backref_limit`` children per parent).
+
+    With ``keys_only``, only the key columns of the rows are fetched (their
+    primary key and the columns needed to reach their children). Sets of
+    more than ``temp_table_threshold`` keys are joined from a temporary
+    table instead of being sent as ``IN`` lists (see ``iter_rows_by_keys``).
+    """
+
+    def __init__(self, query, keys_only=False, temp_table_threshold=None):
+        self.query = query
+        self.session = query.session
+        self.keys_only = keys_only
+        self.temp_table_threshold = temp_table_threshold
+        self.backref_limit = query.query_dict.get("backref_limit")
+        self.rows = OrderedDict()
+        self.count = 0
+        self.last_key = None
+
+    def walk(self):
+        """Return the fetched rows by table name, each table rows being an
+        ordered dict of rows by key.
+        """
+        root = self.query.relation_tree
+        table = self.query.model_class.__table__
+        statement = self.query.enable_eagerloads(False).statement.alias()
+        columns = self.get_columns(table, root.children)
+        rows = self.fetch(select([statement.c[c.key] for c in columns]), columns)
+        self.count = len(rows)
+        if rows:
+            self.last_key = get_row_key(table, rows[-1])
+        queue = deque([(root, self.add_rows(table, rows))])
+        while queue:
+            node, rows = queue.popleft()
+            for child in node.children:
+                queue.append((child, self.walk_relationship(child, rows)))
+        return self.rows
+
+    def walk_relationship(self, node, parent_rows):
+        relationship = node.relationship
+        limit = None
+        if relationship.direction is interfaces.ONETOMANY:
+            limit = self.backref_limit
+
+        pairs = get_relationship_pairs(relationship)
+        if relationship.direction is interfaces.MANYTOMANY:
+            secondary = relationship.secondary
+            columns = self.get_columns(secondary, extra_columns=pairs[1])
+            parent_rows = self.add_rows(
+                secondary,
+                self.fetch_related(secondary, columns, pairs[0], parent_rows),
+            )
+
+        target = relationship.target
+        columns = self.get_columns(target, node.children)
+        rows = self.fetch_related(target, columns, pairs[-1], parent_rows, limit)
+        return self.add_rows(target, rows)
+
+    def get_columns(self, table, children=(), extra_columns=()):
+        if not self.keys_only:
+            return list(table.columns)
+        keys = [c.key for c in get_key_columns(table)]
+        for child in children:
+            for column, _ in get_relationship_pairs(child.relationship)[0]:
+                keys.append(column.key)
+        for column, _ in extra_columns:
+            keys.append(column.key)
+        return [table.c[key] for key in OrderedDict.fromkeys(keys)]
+
+    def fetch(self, statement, columns):
+        connection = self.session.connection()
+        result = connection.execution_options(stream_results=True).execute(statement)
+        return [OrderedDict(zip((c.key for c in columns), row)) for row in result]
+
+    def fetch_related(self, table, columns, pairs, parent_rows, limit=None):
+        local_keys = [local.key for local, _ in pairs]
+        remote_columns = [table.c[remote.key] for _, remote in pairs]
+        values = set()
+        for row in parent_rows:
+            value = tuple(row[key] for key in local_keys)
+            if None not in value:
+                values.add(value)
+
+        rows = []
+        for batch in iter_rows_by_keys(
+            self.session,
+            table,
+            columns,
+            remote_columns,
+            values,
+            limit,
+            self.temp_table_threshold,
+        ):
+            rows.extend(batch)
+        return rows
+
+    def add_rows(self, table, rows):
+        """Merge ``rows`` into the fetched rows of ``table`` and return them
+        without duplicates.
+        """
+        table_rows = self.rows.setdefault(table.name, OrderedDict())
+        unique_rows = OrderedDict()
+        for row in rows:
+            key = get_row_key(table, row)
+            if key in table_rows:
+                table_rows[key].update(row)
+            else:
+                table_rows[key] = row
+            unique_rows[key] = table_rows[key]
+        return list(unique_rows.values())
+
+
+class RowBatch(object):
+    """Rows of a batch of root rows and of their relations, grouped by table
+    name. Its length is the number of root rows, ``last_key`` is the key of
+    the last one. ``stored_keys`` holds the keys of the rows read from the
+    row store, by table name.
+    """
+
+    def __init__(self, rows, count, last_key=None, stored_keys=None):
+        self.rows = rows
+        self.count = count
+        self.last_key = last_key
+        self.stored_keys = stored_keys or {}
+
+    @classmethod
+    def fetch(cls, query, row_store=None):
+        """Fetch the rows of ``query`` and of its relation tree.
+
+        With a ``row_store`` (see ``dbcut.cache.RowStore``), only the keys of
+        the rows are walked and the rows that are not stored yet are fetched.
+        """
+        walker = RelationWalker(
+            query,
+            keys_only=row_store is not None,
+            temp_table_threshold=query.temp_table_threshold,
+        )
+        rows = walker.walk()
+        batch = cls(
+            OrderedDict((name, list(r.values())) for name, r in rows.items()),
+            walker.count,
+            walker.last_key,
+        )
+        if row_store is None:
+            return batch
+
+        def fetch_missing(table, keys):
+            return fetch_rows_by_keys(
+                query.session, table, keys, query.temp_table_threshold
+            )
+
+        return row_store.load_batch(batch, query.session.db.tables, fetch_missing)
+
+    def __len__(self):
+        return self.count
+
+
+class ExtractionPlan(object):
+    """Merge the queries into a single extraction plan.
+
+    Only the keys of the rows reached by every query are fetched and merged
+    by table, so that the full rows of each table are then fetched (and
+    inserted) exactly once whatever the number of queries reaching them.
+    """
+
+    def __init__(self, db, temp_table_threshold=None):
+        self.db = db
+        self.temp_table_threshold = temp_table_threshold
+        self.keys = OrderedDict()
+
+    def add_query(self, query):
+        """Add the keys of the rows of ``query`` to the plan and return the
+        number of rows reached by the query.
+        """
+        count = 0
+        walker = RelationWalker(
+            query, keys_only=True, temp_table_threshold=self.temp_table_threshold
+        )
+        for table_name, rows in walker.walk().items():
+            self.keys.setdefault(table_name, set()).update(rows.keys())
+            count += len(rows)
+        return count
+
+    def count(self, table_name=None):
+        if table_name is None:
+            return sum(len(keys) for keys in self.keys.values())
+        return len(self.keys.get(table_name, ()))
+
+    def iter_rows(self, table_name, batch_size=None):
+        """Fetch the full rows of ``table_name`` planned for extraction, by
+        batches of ``batch_size`` rows.
+        """
+        table = self.db.tables[table_name]
+        batches = iter_rows_by_keys(
+            self.db.session,
+            table,
+            list(table.columns),
+            get_key_columns(table),
+            self.keys.get(table_name, ()),
+            temp_table_threshold=self.temp_table_threshold,
+        )
+        return rebatch(batches, batch_size)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import heapq
+import itertools
+import os
+import pickle
+import threading
+from collections import namedtuple
+
+from sqlalchemy.orm import interfaces
+
+from .compression import get_codec, read_compressed, write_compressed
+from .serializer import to_json
+from .utils import AtomicFile, FileLock, cached_property
+
+__all__ = ["Edge", "RelationPlanCache", "SchemaGraph"]
+
+
+Edge = namedtuple(
+    "Edge", ["relationship", "key", "target", "backref", "path", "reverse_path"]
+)
+Edge.__doc__ = """A relationship of the schema graph.
+
+``backref`` is True for one-to-many and many-to-many relationships, ``path``
+and ``reverse_path`` identify the relationship in both directions.
+"""
+
+
+def get_relationship_path(relationship):
+    local_table_name = relationship.parent.class_.__table__.name
+    if relationship.direction in (interfaces.ONETOMANY, interfaces.MANYTOMANY):
+        key = relationship.key
+    else:
+        key = list(relationship.local_columns)[0].name
+    return "{}.{}".format(local_table_name, key)
+
+
+def get_relationship_reverse_path(relationship):
+    remote_table_name = relationship.target.name
+    if relationship.direction in (interfaces.ONETOMANY, interfaces.MANYTOMANY):
+        key = list(relationship.remote_side)[0].name
+    else:
+        key = relationship.back_populates
+    return "{}.{}".format(remote_table_name, key)
+
+
+def get_manytoone_relationships_first(model):
+    def key(relationship):
+        if relationship.direction is interfaces.MANYTOONE:
+            return 0
+        return 1
+
+    return sorted(model.__mapper__.relationships.values(), key=key)
+
+
+class SchemaGraph(object):
+    """Adjacency lists of the relationships between the reflected models.
+
+    The graph is built once per reflected metadata so that walking it to
+    build relation trees only does dictionary and set lookups.
+    """
+
+    def __init__(self, models):
+        self.edges = {}
+        self.relationships = {}
+        for name, model in models.items():
+            self.edges[name] = tuple(
+                Edge(
+                    relationship=relationship,
+                    key=relationship.key,
+                    target=relationship.target.name,
+                    backref=relationship.direction is not interfaces.MANYTOONE,
+                    path=get_relationship_path(relationship),
+                    reverse_path=get_relationship_reverse_path(relationship),
+                )
+                for relationship in get_manytoone_relationships_first(model)
+            )
+            for edge in self.edges[name]:
+                self.relationships[(name, edge.key)] = edge.relationship
+        self._shortest_paths = {}
+
+    def __len__(self):
+        return len(self.edges)
+
+    def neighbors(self, model_name):
+        """Returns the edges of ``model_name``, many-to-one relationships first."""
+        return self.edges.get(model_name, ())
+
+    def relationship(self, model_name, key):
+        return self.relationships[(model_name, key)]
+
+    def shortest_paths(self, source, exclude=()):
+        """Returns the lightest paths from ``source`` to the other models.
+
+        As for the nodes of relation trees, the weight of a path doubles with
+        each one-to-many or many-to-many relationship. Ties are broken by the
+        number of relationships, then by the order of the edges. The paths are
+        computed once per ``(source, exclude)``.
+        """
+        key = (source, frozenset(exclude))
+        paths = self._shortest_paths.get(key)
+        if paths is None:
+            paths = self._shortest_paths[key] = ShortestPaths(self, *key)
+        return paths
+
+    @cached_property
+    def fingerprint(self):
+        """Hash of the relationships of the graph and of their columns."""
+        edges = sorted(
+            [
+                name,
+                edge.key,
+                edge.target,
+                edge.relationship.direction.name,
+                sorted(column.name for column in edge.relationship.local_columns),
+                sorted(column.name for column in edge.relationship.remote_side),
+            ]
+            for name, edges in self.edges.items()
+            for edge in edges
+        )
+        return hashlib.sha1(to_json(edges).encode("utf-8")).hexdigest()
+
+
+class ShortestPaths(object):
+    """Lightest paths from ``source`` to every reachable model (Dijkstra)."""
+
+    def __init__(self, graph, source, exclude):
+        self.source = source
+        self.previous = {}
+        if source in exclude:
+            return
+        costs = {source: (0, 0)}
+        counter = itertools.count()
+        queue = [(0, 0, next(counter), source)]
+        done = set()
+        while queue:
+            backrefs, hops, _, name = heapq.heappop(queue)
+            if name in done:
+                continue
+            done.add(name)
+            for edge in graph.neighbors(name):
+                if edge.target in exclude or edge.target in done:
+                    continue
+                cost = (backrefs + edge.backref, hops + 1)
+                if edge.target not in costs or cost < costs[edge.target]:
+                    costs[edge.target] = cost
+                    self.previous[edge.target] = (name, edge)
+                    heapq.heappush(queue, cost + (next(counter), edge.target))
+
+    def __contains__(self, target):
+        return target in self.previous
+
+    def edges(self, target):
+        """Returns the edges leading from ``source`` to ``target``, or an empty
+        list if ``target`` cannot be reached.
+        """
+        path = []
+        while target in self.previous:
+            target, edge = self.previous[target]
+            path.append(edge)
+        return path[::-1]
+
+
+class RelationPlanCache(object):
+    """Relation plans of the queries computed on a schema graph.
+
+    The plans are kept in memory and, if ``path`` is given, the new ones are
+    saved to this file (compressed with ``codec``) along with the fingerprint
+    of the graph by ``save``, merged with the plans saved in the meantime by
+    other processes. The file is ignored once the fingerprint has changed.
+    """
+
+    def __init__(self, graph, path=None, codec=None):
+        self.graph = graph
+        self.path = path
+        self.codec = codec or get_codec("none")
+        self._plans = None
+        self._new_keys = set()
+        self._lock = threading.Lock()
+
+    @property
+    def plans(self):
+        if self._plans is None:
+            self._plans = self.read()
+        return self._plans
+
+    def read(self):
+        """Return the plans saved to ``path`` for the graph."""
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "rb") as cache_file:
+                fingerprint, plans = pickle.loads(read_compressed(cache_file))
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return {}
+        if fingerprint != self.graph.fingerprint:
+            return {}
+        return plans
+
+    def get(self, key):
+        with self._lock:
+            return self.plans.get(key)
+
+    def set(self, key, plan):
+        with self._lock:
+            self.plans[key] = plan
+            self._new_keys.add(key)
+
+    def save(self):
+        """Save the new plans to ``path``, once per run instead of once per
+        plan."""
+        with self._lock:
+            if self.path is None or not self._new_keys:
+                return
+            # other processes may have saved their plans since they were read
+            lock = FileLock("{}.lock".format(self.path))
+            lock.acquire()
+            try:
+                plans = self.read()
+                plans.update((key, self._plans[key]) for key in self._new_keys)
+                data = pickle.dumps((self.graph.fingerprint, plans))
+                with AtomicFile(self.path) as cache_file:
+                    write_compressed(cache_file, data, self.codec)
+            finally:
+                lock.release()
+            self._new_keys.clear()
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+import json
+import os
+import tempfile
+from abc import ABCMeta, abstractmethod
+from collections import Counter, OrderedDict
+
+from sqlalchemy import and_, bindparam, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import class_mapper, interfaces
+from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy.schema import sort_tables_and_constraints
+
+from .utils import cached_property
+
+__all__ = [
+    "InsertLoader",
+    "PostgresCopyLoader",
+    "MySQLLoadDataLoader",
+    "PrimaryKeyIndex",
+    "SQLiteLoader",
+    "get_loader",
+    "objects_to_rows",
+]
+
+
+def objects_to_rows(objects):
+    """Flatten graphs of loaded objects into rows grouped by table name.
+
+    Every reachable object (through its loaded relationships) gives one row
+    per table, many-to-many collections also give the rows of their
+    association table.
+    """
+    rows = OrderedDict()
+    seen_rows = {}
+    seen_objects = set()
+
+    def add_row(table, row):
+        pk = tuple(row.get(c.key) for c in table.primary_key.columns)
+        table_seen_rows = seen_rows.setdefault(table.name, set())
+        if pk and pk in table_seen_rows:
+            return
+        table_seen_rows.add(pk)
+        rows.setdefault(table.name, []).append(row)
+
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if obj is None or id(obj) in seen_objects:
+            continue
+        seen_objects.add(id(obj))
+        state = instance_state(obj)
+        mapper = state.mapper
+        values = state.dict
+
+        row = OrderedDict()
+        for prop in mapper.column_attrs:
+            if prop.key in values:
+                row[prop.columns[0].key] = values[prop.key]
+        add_row(mapper.local_table, row)
+
+        for relationship in mapper.relationships:
+            if relationship.key not in values:
+                continue
+            value = values[relationship.key]
+            if relationship.direction is interfaces.MANYTOONE:
+                stack.append(value)
+                continue
+            related_objects = list(value or [])
+            stack.extend(related_objects)
+            if relationship.direction is interfaces.MANYTOMANY:
+                for related_obj in related_objects:
+                    add_row(
+                        relationship.secondary,
+                        get_secondary_row(relationship, values, related_obj),
+                    )
+
+    return rows
+
+
+def get_secondary_row(relationship, values, related_obj):
+    related_values = instance_state(related_obj).dict
+    related_mapper = class_mapper(type(related_obj))
+    row = OrderedDict()
+    for column, secondary_column in relationship.synchronize_pairs:
+        prop = relationship.parent.get_property_by_column(column)
+        row[secondary_column.key] = values.get(prop.key)
+    for column, secondary_column in relationship.secondary_synchronize_pairs:
+        prop = related_mapper.get_property_by_column(column)
+        row[secondary_column.key] = related_values.get(prop.key)
+    return row
+
+
+def group_rows_by_keys(rows):
+    """Group rows by column names so that each group can be inserted with
+    a single ``executemany``.
+
+    Examples::
+
+    >>> list(group_rows_by_keys([{"a": 1}, {"a": 2, "b": 3}, {"a": 4}]))
+    [[{'a': 1}, {'a': 4}], [{'a': 2, 'b': 3}]]
+    """
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(tuple(row.keys()), []).append(row)
+    return groups.values()
+
+
+class PrimaryKeyIndex(object):
+    """Primary keys of the rows already loaded, by table.
+
+    Rows reached by several queries are only loaded once: the following
+    ones are filtered out before being turned into ``INSERT`` statements.
+    Keys are kept in one set per table, single column keys being stored as
+    plain values rather than tuples. Tables without primary key are not
+    indexed.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def filter(self, table, rows):
+        """Return the rows of ``table`` not loaded yet and index them."""
+        pk_keys = [c.key for c in table.primary_key.columns]
+        if not pk_keys:
+            return rows
+        keys = self.keys.setdefault(table.name, set())
+        new_rows = []
+        for row in rows:
+            if len(pk_keys) == 1:
+                key = row.get(pk_keys[0])
+            else:
+                key = tuple(row.get(k) for k in pk_keys)
+            if key in keys:
+                continue
+            keys.add(key)
+            new_rows.append(row)
+        self.hits[table.name] += len(rows) - len(new_rows)
+        self.misses[table.name] += len(new_rows)
+        return new_rows
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.keys.values())
+
+
+class InsertLoader(object):
+    """Insert rows with Core ``executemany`` statements, table by table in
+    foreign key dependency order.
+
+    Foreign keys involved in a dependency cycle are inserted as ``NULL`` and
+    set afterwards by a second pass of ``UPDATE`` statements.
+
+    With a :class:`PrimaryKeyIndex`, the rows already loaded are skipped.
+    """
+
+    name = "insert"
+
+    def __init__(self, session, metadata=None, index=None):
+        self.session = session
+        self.metadata = metadata if metadata is not None else session.db.metadata
+        self.index = index
+
+    @property
+    def connection(self):
+        if hasattr(self.session, "get_bind"):
+            return self.session.connection()
+        return self.session
+
+    @property
+    def dialect(self):
+        return self.connection.dialect
+
+    @cached_property
+    def sorted_tables_and_constraints(self):
+        return sort_tables_and_constraints(self.metadata.tables.values())
+
+    @cached_property
+    def sorted_tables(self):
+        return [t for t, _ in self.sorted_tables_and_constraints if t is not None]
+
+    @cached_property
+    def deferred_columns(self):
+        deferred_columns = {}
+        for table, constraints in self.sorted_tables_and_constraints:
+            if table is not None:
+                continue
+            for constraint in constraints:
+                if all(c.nullable and not c.primary_key for c in constraint.columns):
+                    deferred_columns.setdefault(constraint.table.name, set()).update(
+                        c.key for c in constraint.columns
+                    )
+        return deferred_columns
+
+    def load(self, rows_by_table):
+        """Insert ``rows_by_table`` and return the number of inserted rows."""
+        count = 0
+        deferred_updates = []
+        for table in self.sorted_tables:
+            rows = rows_by_table.get(table.name)
+            if rows and self.index is not None:
+                rows = self.index.filter(table, rows)
+            if not rows:
+                continue
+            deferred_keys = self.deferred_columns.get(table.name)
+            if deferred_keys:
+                rows, updates = self.split_deferred_values(table, rows, deferred_keys)
+                if updates:
+                    deferred_updates.append((table, updates))
+            self.insert(table, rows)
+            count += len(rows)
+
+        for table, updates in deferred_updates:
+            self.update(table, updates)
+
+        return count
+
+    def insert(self, table, rows):
+        for group in group_rows_by_keys(rows):
+            self.session.execute(table.insert(), group)
+
+    def update(self, table, rows):
+        pk_columns = list(table.primary_key.columns)
+        for group in group_rows_by_keys(rows):
+            keys = [k for k in group[0].keys() if k.startswith("_v_")]
+            statement = (
+                table.update()
+                .where(and_(*[c == bindparam("_pk_" + c.key) for c in pk_columns]))
+                .values({k[3:]: bindparam(k) for k in keys})
+            )
+            self.session.execute(statement, group)
+
+    def split_deferred_values(self, table, rows, deferred_keys):
+        pk_keys = [c.key for c in table.primary_key.columns]
+        insert_rows = []
+        updates = []
+        for row in rows:
+            deferred_values = OrderedDict(
+                (k, row[k]) for k in row if k in deferred_keys and row[k] is not None
+            )
+            if deferred_values and pk_keys:
+                row = OrderedDict(row)
+                update = OrderedDict(("_pk_" + k, row[k]) for k in pk_keys)
+                for key, value in deferred_values.items():
+                    row[key] = None
+                    update["_v_" + key] = value
+                updates.append(update)
+            insert_rows.append(row)
+        return insert_rows, updates
+
+
+class NativeLoaderUnavailable(Exception):
+    pass
+
+
+class NativeLoader(InsertLoader, metaclass=ABCMeta):
+    """Base class of the loaders using the fastest bulk load path of a DBMS.
+
+    Rows that cannot be loaded with the native path are inserted with the
+    regular ``INSERT`` statements of :class:`InsertLoader`. Once the native
+    path fails with a database error (``LOAD DATA`` disabled by the server for
+    instance), it is not tried again by this loader.
+    """
+
+    name = "native"
+    use_savepoint = False
+
+    def __init__(self, session, metadata=None, index=None):
+        super(NativeLoader, self).__init__(session, metadata, index)
+        self.native_available = True
+
+    def insert(self, table, rows):
+        # the native paths use raw DBAPI cursors, whose errors are not wrapped
+        # in a DBAPIError
+        database_errors = (DBAPIError, self.dialect.dbapi.Error)
+        for group in group_rows_by_keys(rows):
+            if not self.native_available:
+                super(NativeLoader, self).insert(table, group)
+                continue
+            try:
+                if self.use_savepoint:
+                    with self.session.begin_nested():
+                        self.native_insert(table, group)
+                else:
+                    self.native_insert(table, group)
+            except NativeLoaderUnavailable:
+                super(NativeLoader, self).insert(table, group)
+            except database_errors:
+                self.native_available = False
+                super(NativeLoader, self).insert(table, group)
+
+    @abstractmethod
+    def native_insert(self, table, rows):
+        """Load ``rows`` into ``table`` with the native path, or raise
+        :class:`NativeLoaderUnavailable` if they cannot be loaded this way."""
+
+    @property
+    def dbapi_connection(self):
+        return self.connection.connection
+
+    def quote(self, name):
+        return self.dialect.identifier_preparer.quote(name)
+
+    def format_table(self, table):
+        return self.dialect.identifier_preparer.format_table(table)
+
+
+class PostgresCopyLoader(NativeLoader):
+    """Load rows with ``COPY ... FROM STDIN`` into a temporary table, then
+    move them to the target table with ``INSERT ... ON CONFLICT DO NOTHING``.
+    """
+
+    use_savepoint = True
+
+    def native_insert(self, table, rows):
+        cursor = self.dbapi_connection.cursor()
+        try:
+            if not hasattr(cursor, "copy_expert"):
+                raise NativeLoaderUnavailable()
+
+            keys = list(rows[0].keys())
+            columns = ", ".join(self.quote(table.c[k].name) for k in keys)
+            tmp_table = self.quote("dbcut_copy_%s" % table.name)
+            stream = io.StringIO()
+            for row in rows:
+                stream.write("\t".join(pg_copy_value(row[k]) for k in keys))
+                stream.write("\n")
+            stream.seek(0)
+
+            cursor.execute(
+                "CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS)"
+                % (tmp_table, self.format_table(table))
+            )
+            try:
+                cursor.copy_expert(
+                    "COPY %s (%s) FROM STDIN" % (tmp_table, columns), stream
+                )
+                cursor.execute(
+                    "INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT DO NOTHING"
+                    % (self.format_table(table), columns, columns, tmp_table)
+                )
+            finally:
+                cursor.execute("DROP TABLE %s" % tmp_table)
+        finally:
+            cursor.close()
+
+
+class MySQLLoadDataLoader(NativeLoader):
+    """Load rows with ``LOAD DATA LOCAL INFILE``.
+
+    The server and the client must allow it (``local_infile=1`` in the
+    destination uri query string).
+    """
+
+    def native_insert(self, table, rows):
+        keys = list(rows[0].keys())
+        columns = ", ".join(self.quote(table.c[k].name) for k in keys)
+        fd, path = tempfile.mkstemp(prefix="dbcut-", suffix=".tsv")
+        try:
+            with io.open(fd, "w", encoding="utf-8", newline="") as stream:
+                for row in rows:
+                    stream.write("\t".join(mysql_load_data_value(row[k]) for k in keys))
+                    stream.write("\n")
+            self.connection.execute(
+                text(
+                    "LOAD DATA LOCAL INFILE :path IGNORE INTO TABLE %s "
+                    "CHARACTER SET utf8mb4 "
+                    "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+                    "LINES TERMINATED BY '\\n' (%s)"
+                    % (self.format_table(table), columns)
+                ),
+                {"path": path},
+            )
+        finally:
+            os.remove(path)
+
+
+class SQLiteLoader(NativeLoader):
+    """Load rows with one DBAPI ``executemany`` per table, bypassing the
+    SQLAlchemy statement execution machinery.
+    """
+
+    def native_insert(self, table, rows):
+        keys = list(rows[0].keys())
+        compiled = table.insert().compile(dialect=self.dialect, column_keys=keys)
+        positions = compiled.positiontup
+        processors = [
+            table.c[key].type.dialect_impl(self.dialect).bind_processor(self.dialect)
+            for key in positions
+        ]
+        params = [
+            tuple(
+                processor(row[key]) if processor else row[key]
+                for key, processor in zip(positions, processors)
+            )
+            for row in rows
+        ]
+        self.dbapi_connection.cursor().executemany(str(compiled), params)
+
+
+NATIVE_LOADERS = {
+    "postgresql": PostgresCopyLoader,
+    "mysql": MySQLLoadDataLoader,
+    "sqlite": SQLiteLoader,
+}
+
+LOADERS = ("native", "insert")
+
+
+def get_loader(session, metadata=None, name="native", index=None):
+    """Return the loader called ``name`` for the dialect of ``session``.
+
+    The ``native`` loader falls back to :class:`InsertLoader` for the
+    dialects without a native bulk load path.
+    """
+    if name not in LOADERS:
+        raise ValueError(
+            "Unknown loader %r (expected one of %s)" % (name, ", ".join(LOADERS))
+        )
+    loader = InsertLoader(session, metadata, index)
+    if name == "native":
+        loader_class = NATIVE_LOADERS.get(loader.dialect.name, InsertLoader)
+        loader = loader_class(session, metadata, index)
+    return loader
+
+
+def escape_copy_text(value):
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def pg_copy_value(value):
+    r"""Format ``value`` for the text format of PostgreSQL ``COPY``.
+
+    Examples::
+
+    >>> pg_copy_value(None), pg_copy_value(True), pg_copy_value("a\tb")
+    ('\\N', 't', 'a\\tb')
+    >>> pg_copy_value(b"\x01\xff")
+    '\\\\x01ff'
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    return escape_copy_text(str(value))
+
+
+def mysql_load_data_value(value):
+    r"""Format ``value`` for MySQL ``LOAD DATA`` with the default escaping.
+
+    Examples::
+
+    >>> mysql_load_data_value(None), mysql_load_data_value(False)
+    ('\\N', '0')
+    >>> mysql_load_data_value("a\nb")
+    'a\\nb'
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        raise NativeLoaderUnavailable()
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return escape_copy_text(str(value)).replace("\0", "\\0")
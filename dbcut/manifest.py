@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""Manifest of the cache directory.
+
+The cached queries of a cache directory are indexed in a SQLite database at
+its root, ``manifest.sqlite``: their size, number of objects and rows, codec,
+schema fingerprint and creation and last access times. Looking up a query,
+reporting the cache usage or evicting queries (see ``evict_cache``) only reads
+the manifest instead of the cache files. The counters of the cache (see
+``CacheStats``) and the high-water marks of the change-tracking columns of the
+cached queries (see ``dbcut.query.CacheRefresher``) are kept in the manifest
+too.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import Counter, namedtuple
+
+from .cache import RowStore, read_cache_keys
+
+__all__ = ["CacheEntry", "CacheManifest", "CacheStats", "evict_cache"]
+
+
+CacheEntry = namedtuple(
+    "CacheEntry",
+    ["path", "size", "count", "rows", "codec", "fingerprint", "created", "accessed"],
+)
+CacheEntry.__doc__ = """A cached query: the path of its cache file, the size
+of this file, its number of root objects and of rows, the codec of the file,
+the fingerprint of the schema it was cached with and the times it was created
+and last read.
+"""
+
+
+class CacheManifest(object):
+    """Index of the cached queries of ``directory`` (see the module)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, "manifest.sqlite")
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(
+                self.path, timeout=60, check_same_thread=False
+            )
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS entries ("
+                    "key TEXT NOT NULL PRIMARY KEY, "
+                    "size INTEGER NOT NULL, "
+                    "count INTEGER NOT NULL, "
+                    "rows INTEGER NOT NULL, "
+                    "codec TEXT NOT NULL, "
+                    "fingerprint TEXT, "
+                    "created REAL NOT NULL, "
+                    "accessed REAL NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS counters ("
+                    "name TEXT NOT NULL PRIMARY KEY, "
+                    "value INTEGER NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS marks ("
+                    "key TEXT NOT NULL, "
+                    "table_name TEXT NOT NULL, "
+                    "column_name TEXT NOT NULL, "
+                    "value BLOB NOT NULL, "
+                    "PRIMARY KEY (key, table_name))"
+                )
+        return self._connection
+
+    def key(self, path):
+        return os.path.relpath(path, self.directory)
+
+    def _entry(self, row):
+        key = row[0]
+        return CacheEntry(os.path.join(self.directory, key), *row[1:])
+
+    def get(self, path):
+        """Return the entry of the cache file ``path``, or ``None``."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT * FROM entries WHERE key = ?", (self.key(path),)
+            ).fetchone()
+        if row is not None:
+            return self._entry(row)
+
+    def add(self, path, count, rows, codec, fingerprint=None, marks=None):
+        """Index the cache file ``path``, once written, with the high-water
+        ``marks`` of its tables (see ``marks``)."""
+        now = time.time()
+        key = self.key(path)
+        with self._lock, self.connection as connection:
+            connection.execute("DELETE FROM marks WHERE key = ?", (key,))
+            connection.executemany(
+                "INSERT INTO marks VALUES (?, ?, ?, ?)",
+                (
+                    (key, table_name, column_name, pickle.dumps(value))
+                    for table_name, (column_name, value) in (marks or {}).items()
+                ),
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    os.path.getsize(path),
+                    count,
+                    rows,
+                    codec,
+                    fingerprint,
+                    now,
+                    now,
+                ),
+            )
+
+    def touch(self, path):
+        """Record that the cache file ``path`` has just been read."""
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?",
+                (time.time(), self.key(path)),
+            )
+
+    def marks(self, path):
+        """Return the high-water marks of the tables of the cache file
+        ``path``: the latest value of their change-tracking column, as
+        ``(column name, value)`` by table name."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT table_name, column_name, value FROM marks WHERE key = ?",
+                (self.key(path),),
+            ).fetchall()
+        return dict(
+            (table_name, (column_name, pickle.loads(value)))
+            for table_name, column_name, value in rows
+        )
+
+    def remove(self, path):
+        with self._lock, self.connection as connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (self.key(path),))
+            connection.execute("DELETE FROM marks WHERE key = ?", (self.key(path),))
+
+    def entries(self):
+        """Return all the entries, the least recently used first."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT * FROM entries ORDER BY accessed"
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def disk_usage(self, entries=None):
+        """Size of the cache files and of the row stores of the entries."""
+        if entries is None:
+            entries = self.entries()
+        size = sum(entry.size for entry in entries)
+        for directory in set(os.path.dirname(entry.path) for entry in entries):
+            path = os.path.join(directory, "rows.cache")
+            if os.path.exists(path):
+                store = RowStore(path)
+                try:
+                    size += store.disk_usage()
+                finally:
+                    store.close()
+        return size
+
+    def purge(self):
+        """Remove all the cache files of the manifest and their entries.
+        Returns the removed entries."""
+        entries = self.entries()
+        for entry in entries:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        with self._lock, self.connection as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM marks")
+        return entries
+
+    def add_counters(self, counters):
+        with self._lock, self.connection as connection:
+            for name, value in counters.items():
+                connection.execute(
+                    "INSERT OR IGNORE INTO counters VALUES (?, 0)", (name,)
+                )
+                connection.execute(
+                    "UPDATE counters SET value = value + ? WHERE name = ?",
+                    (value, name),
+                )
+
+    def counters(self):
+        with self._lock:
+            return dict(self.connection.execute("SELECT name, value FROM counters"))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class CacheStats(object):
+    """Counters of the cache, added to the totals of the manifest by ``save``
+    so that they persist across runs.
+
+    ``hits`` and ``misses`` count the queries loaded from the cache and
+    fetched from the source database, ``rows_hits`` and ``rows_misses`` the
+    rows read from the row store and fetched because they were missing from
+    it, ``bytes_saved`` the size of the rows read from the row store and
+    ``evictions`` the queries evicted by ``evict_cache``.
+    """
+
+    COUNTERS = (
+        "hits",
+        "misses",
+        "rows_hits",
+        "rows_misses",
+        "bytes_saved",
+        "evictions",
+    )
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def totals(self):
+        """Return the saved totals plus the counters not saved yet."""
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        totals.update(self.manifest.counters())
+        with self._lock:
+            for name, value in self.counters.items():
+                totals[name] += value
+        return totals
+
+    def save(self):
+        with self._lock:
+            counters = self.counters
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.manifest.add_counters(counters)
+
+
+def evict_cache(manifest, max_size):
+    """Evict the least recently used queries of the cache until its size
+    (see ``CacheManifest.disk_usage``) is at most ``max_size`` bytes. Returns
+    the evicted entries.
+
+    The rows of the row stores are counted by reference: evicting a query
+    removes the rows that no other query references from the row stores. The
+    other rows are left alone, as those of the queries being cached by other
+    processes, which are not in the manifest yet.
+    """
+    entries = manifest.entries()
+    size = manifest.disk_usage(entries)
+    if size <= max_size:
+        return []
+
+    entries_keys = {}
+    references = {}
+    for entry in entries:
+        try:
+            entries_keys[entry] = read_cache_keys(entry.path)
+        except (IOError, ValueError):
+            entries_keys[entry] = {}
+        counter = references.setdefault(os.path.dirname(entry.path), Counter())
+        for table_name, keys in entries_keys[entry].items():
+            counter.update((table_name, key) for key in keys)
+
+    stores = {}
+    # size on disk of each byte of row, with the indexes and pages of SQLite
+    overheads = {}
+    evicted = []
+    try:
+        for entry in entries:
+            if size <= max_size:
+                break
+            manifest.remove(entry.path)
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+            evicted.append(entry)
+            size -= entry.size
+
+            directory = os.path.dirname(entry.path)
+            counter = references[directory]
+            path = os.path.join(directory, "rows.cache")
+            if not os.path.exists(path):
+                continue
+            if directory not in stores:
+                stores[directory] = RowStore(path)
+                overheads[directory] = stores[directory].disk_usage() / max(
+                    stores[directory].total_size(), 1
+                )
+            for table_name, keys in entries_keys[entry].items():
+                freed_keys = []
+                for key in keys:
+                    counter[(table_name, key)] -= 1
+                    if not counter[(table_name, key)]:
+                        freed_keys.append(key)
+                freed_size = stores[directory].size(table_name, freed_keys)
+                stores[directory].delete(table_name, freed_keys)
+                size -= freed_size * overheads[directory]
+    finally:
+        for store in stores.values():
+            store.close()
+    return evicted
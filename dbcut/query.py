@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import os
+from collections import OrderedDict, namedtuple
 from pickle import PicklingError
 from weakref import WeakSet
 
 import yaml
 from pptree import print_tree
 from sqlalchemy import event
-from sqlalchemy.ext import serializer as sa_serializer
 from sqlalchemy.orm import (
     Bundle,
     Query,
@@ -21,14 +21,45 @@ from sqlalchemy.orm.exc import UnmappedClassError
 from sqlalchemy.orm.session import make_transient, object_session
 
 from . import SQLALCHEMY_VERSION
-from .serializer import dump_json, load_json, to_json
-from .utils import aslist, cached_property, redirect_stdout, sorted_nested_dict
+from .cache import ColumnarReader, ColumnarWriter
+from .compression import get_codec
+from .extractor import (
+    RowBatch,
+    estimate_row_count,
+    fetch_rows_by_keys,
+    get_key_columns,
+    get_row_key,
+    keyset_criterion,
+    limit_per_parent,
+    supports_row_count_estimate,
+)
+from .loader import objects_to_rows
+from .serializer import dump_json, to_json
+from .utils import (
+    AtomicFile,
+    FileLock,
+    aslist,
+    cached_property,
+    redirect_stdout,
+    sorted_nested_dict,
+)
+
+# How the root objects of a query are counted before being fetched
+COUNT_MODES = ("exact", "estimate", "none")
+
+RefreshResult = namedtuple("RefreshResult", ["refreshed", "deleted"])
+RefreshResult.__doc__ = """Number of cached rows fetched again and deleted by an
+incremental refresh (see ``CacheRefresher``)."""
 
 
 class BaseQuery(Query):
 
     query_dict = None
     relation_tree = None
+    engine = "orm"
+    temp_table_threshold = None
+    fetched_count = None
+    row_store = None
 
     def __init__(self, *args, **kwargs):
         super(BaseQuery, self).__init__(*args, **kwargs)
@@ -74,6 +105,8 @@ class BaseQuery(Query):
     @property
     def cache_basename(self):
         basename = "{}-{}".format(self.model_class.__name__, self.cache_key)
+        if self.engine != "orm":
+            basename = "{}.{}".format(basename, self.engine)
         return os.path.join(self.session.db.cache_dir, basename)
 
     @property
@@ -86,15 +119,18 @@ class BaseQuery(Query):
         return os.path.abspath(os.path.join(os.getcwd(), "{}.json".format(basename)))
 
     @property
-    def count_cache_file(self):
-        return "{}.count".format(self.cache_basename)
+    def cache_entry(self):
+        """Entry of the cache file in the cache manifest, if it is cached with
+        the current schema."""
+        db = self.session.db
+        entry = db.cache_manifest.get(self.cache_file)
+        if entry is not None and entry.fingerprint == db.schema_fingerprint:
+            return entry
 
     @property
     def is_cached(self):
         if self.query_dict is not None:
-            return os.path.isfile(self.cache_file) and os.path.isfile(
-                self.count_cache_file
-            )
+            return self.cache_entry is not None
         return False
 
     @property
@@ -108,127 +144,190 @@ class BaseQuery(Query):
     def save_to_cache(self, objects=None):
         if objects is None:
             objects = list(self.objects())
-        try:
-            content = sa_serializer.dumps(objects)
-            with open(self.cache_file, "wb") as fd:
-                fd.write(content)
-            count_data = {"count": len(objects)}
-            dump_json(count_data, self.count_cache_file)
-        except PicklingError:
-            pass
+        with self.cache_writer() as writer:
+            writer.write(objects)
+
+    def cache_writer(self):
+        return CacheWriter(self)
+
+    def refresh_cache(self):
+        """Refresh the cached query with the rows changed since it was cached
+        (see ``CacheRefresher``) and return a ``RefreshResult``."""
+        return CacheRefresher(self).refresh()
+
+    def cache_lock(self):
+        """Lock of the cache file, held while the query is fetched and
+        cached (see ``dbcut.utils.FileLock``)."""
+        return FileLock("{}.lock".format(self.cache_file))
 
     def export_to_json(self, objects=None):
         if objects is None:
             objects = list(self.objects())
         dump_json(objects, self.json_file)
 
-    def load_from_cache(self, session=None):
-        session = session or self.session
-        metadata = session.db.metadata
-        count = load_json(self.count_cache_file)["count"]
+    def load_from_cache(self):
+        """Return the number of cached objects and a generator of the
+        ``RowBatch`` read from the cache file, as they were cached.
 
-        with open(self.cache_file, "rb") as fd:
-            return count, sa_serializer.loads(fd.read(), metadata, session)
+        The cache file holds the keys of the rows, which are read from the row
+        store of the database (or fetched again if they are missing from it).
+        """
+        db = self.session.db
+        count = self.cache_entry.count
+        db.cache_manifest.touch(self.cache_file)
+
+        def fetch_missing(table, keys):
+            return fetch_rows_by_keys(
+                self.session, table, keys, self.temp_table_threshold
+            )
+
+        def batches():
+            with open(self.cache_file, "rb") as fd:
+                for keys in ColumnarReader(fd):
+                    yield db.row_store.load_batch(keys, db.tables, fetch_missing)
+
+        return count, batches()
 
     def objects(self, session=None):
         yield from self.transient_objects()
 
+    def estimate_count(self):
+        """Returns the number of root objects estimated by the planner of the
+        source database, without running the query, or ``None``.
+        """
+        statement = self.enable_eagerloads(False).statement
+        estimate = estimate_row_count(self.session.connection(), statement)
+        limit = (self.query_dict or {}).get("limit")
+        if estimate is not None and limit:
+            estimate = min(estimate, limit)
+        # an estimate of 0 rows is not reliable enough to skip the query
+        return estimate or None
+
+    def prefetch_count(self, mode="exact"):
+        """Counts the root objects before fetching them, according to ``mode``
+        (see ``COUNT_MODES``). Only the ``exact`` count can be 0.
+
+        The objects are counted exactly if the source database has no
+        estimates (SQLite).
+        """
+        if mode == "estimate" and not supports_row_count_estimate(
+            self.session.connection().dialect
+        ):
+            mode = "exact"
+        if mode == "exact":
+            return self.count()
+        elif mode == "estimate":
+            return self.estimate_count()
+        return None
+
+    def fetch_batch(self, query=None):
+        """Fetch the objects of ``query`` (this query by default), or a
+        ``RowBatch`` of their rows with the ``core`` engine."""
+        if query is None:
+            query = self
+        if self.engine == "core":
+            return RowBatch.fetch(query, self.row_store)
+        return list(self.transient_objects(query))
+
+    @property
+    def keyset_columns(self):
+        """Primary key columns of the query if it is ordered by them (the
+        default ordering), ``None`` otherwise."""
+        if self.query_dict.get("order_by"):
+            return None
+        return list(self.model_class.__table__.primary_key.columns) or None
+
+    def get_last_key(self, batch):
+        if isinstance(batch, RowBatch):
+            return batch.last_key
+        return self.model_class.__mapper__.primary_key_from_instance(batch[-1])
+
+    def iter_batches(self, batch_size=None):
+        """Fetch objects by batches of ``batch_size`` root objects.
+
+        Every batch is fetched with its own window so that only one batch of
+        objects (and its loaded relations) lives in memory. When the query is
+        ordered by its primary key, each window starts after the last key of
+        the previous one (keyset pagination) instead of using an ``OFFSET``
+        growing with the number of fetched objects.
+        """
+        if not batch_size:
+            yield self.fetch_batch()
+            return
+
+        offset = self.query_dict.get("offset") or 0
+        limit = self.query_dict.get("limit")
+        if limit in (None, False):
+            limit = None
+        keyset_columns = self.keyset_columns
+        query = self.execution_options(stream_results=True)
+        last_key = None
+        fetched = 0
+        while limit is None or fetched < limit:
+            size = batch_size if limit is None else min(batch_size, limit - fetched)
+            if last_key is None:
+                window = query.offset(offset + fetched).limit(size)
+            else:
+                window = (
+                    query.limit(None)
+                    .offset(None)
+                    .filter(keyset_criterion(keyset_columns, last_key))
+                    .limit(size)
+                )
+            batch = self.fetch_batch(window)
+            if batch:
+                yield batch
+            fetched += len(batch)
+            if len(batch) < size:
+                break
+            if keyset_columns is not None:
+                last_key = self.get_last_key(batch)
+
     def transient_objects(self, objects=None, session=None):
+        """Yield ``objects`` once detached from their session.
+
+        Instead of detaching every instance of the session for each object, the
+        whole session is detached at once as soon as an object is still attached
+        to it, so that each loaded instance is visited exactly once.
+        """
         if objects is None:
             objects = self
         for obj in objects:
-            if session is None:
-                session = object_session(obj)
-            for instance in session or []:
-                make_transient(instance)
+            obj_session = object_session(obj)
+            if obj_session is not None:
+                make_session_transient(session or obj_session)
             yield obj
 
     def with_loaded_relations(
         self, max_join_depth, max_backref_depth, exclude, include
     ):
         query = self._clone()
-        models_to_exclude = [
-            self.session.db.models.get(table_name)
-            for table_name in exclude
-            if table_name in self.session.db.models
-        ]
-        models_to_browse = {
-            k: v
-            for k, v in self.session.db.models.items()
-            if v not in models_to_exclude
-        }
-        models_to_load = dict(models_to_browse)
-
-        relations_to_load = []
-        root_node = RelationTree(self.model_class.__name__)
-
-        list(
-            breadth_first_load_generator(
-                relations_to_load,
-                root_node,
-                self.model_class,
-                models_to_load,
-                models_to_browse,
-                max_join_depth,
-                max_backref_depth,
-                [],
-                1,
-                [],
-                [],
-            )
+        db = self.session.db
+        key = (
+            self.model_class.__name__,
+            max_join_depth,
+            max_backref_depth,
+            tuple(sorted(exclude)),
+            tuple(include),
         )
+        plan = db.relation_plans.get(key)
+        if plan is None:
+            plan = self.build_relation_plan(
+                max_join_depth, max_backref_depth, exclude, include
+            )
+            db.relation_plans.set(key, plan)
 
-        if include:
-
-            def get_direct_path(target_name):
-                direct_paths = []
-                leaf_relationship = None
-                relations = sorted(relations_to_load, key=lambda x: x[2])
-                for relationship, path, weight in relations:
-                    if relationship.target.name == target_name:
-                        leaf_relationship = (relationship, path, weight)
-                        break
-                if leaf_relationship is None:
-                    return []
-                direct_paths = [leaf_relationship]
-                other_relations = sorted(
-                    list(set(relations) - set([leaf_relationship])), key=lambda x: x[1]
-                )
-                for relationship, path, weight in other_relations:
-                    if path in leaf_relationship[1]:
-                        direct_paths.append(tuple([relationship, path, weight]))
-
-                return direct_paths
-
-            def cut_relation_tree(relations_to_keep, tree):
-                if tree.relationship in relations_to_keep or tree.relationship is None:
-                    children = []
-                    for child in tree.children:
-                        child_tree = cut_relation_tree(relations_to_keep, child)
-                        if child_tree is not None:
-                            children.append(child_tree)
-                    tree.children = children
-                    return tree
-
-            new_relations_to_load = []
-            leaf_relationships = []
-            for target_name in include:
-                direct_paths = get_direct_path(target_name)
-                if len(direct_paths) > 0:
-                    leaf_relationships.append(direct_paths[0])
-                    new_relations_to_load.extend(get_direct_path(target_name))
-            relations_to_load = new_relations_to_load
-            cut_relation_tree([r for r, p, w in relations_to_load], root_node)
-
-            for _, leaf_path, _ in leaf_relationships:
-                query = query.join(*leaf_path.split("."), isouter=True)
+        graph = db.schema_graph
+        for leaf_path in plan["joins"]:
+            query = query.join(*leaf_path.split("."), isouter=True)
 
-            if leaf_relationships:
-                query = query.group_by(query.model_class)
+        if plan["joins"]:
+            query = query.group_by(query.model_class)
 
-        query.relation_tree = root_node
+        query.relation_tree = RelationTree.from_plan(plan["tree"], graph)
 
-        for relationship, path, weight in sorted(relations_to_load, key=lambda x: x[1]):
+        for (model_name, relationship_key), path in plan["relations"]:
+            relationship = graph.relationship(model_name, relationship_key)
             if relationship.direction is interfaces.ONETOMANY:
                 query = query.options(selectinload(path))
             elif relationship.direction is interfaces.MANYTOMANY:
@@ -238,6 +337,334 @@ class BaseQuery(Query):
 
         return query
 
+    def build_relation_plan(self, max_join_depth, max_backref_depth, exclude, include):
+        """Walks the schema graph to compute the relation tree, the relationships
+        to load and the joins of the query.
+
+        With ``include``, only the lightest paths leading to the included
+        tables are loaded. The plan only holds names so that it can be cached
+        on disk.
+        """
+        graph = self.session.db.schema_graph
+        model_name = self.model_class.__name__
+        root_node = RelationTree(model_name)
+        relations_to_load = []
+        leaf_paths = []
+
+        if include:
+            shortest_paths = graph.shortest_paths(model_name, exclude)
+            paths_to_load = set()
+            for target_name in include:
+                if target_name in shortest_paths:
+                    path = [edge.key for edge in shortest_paths.edges(target_name)]
+                    leaf_paths.append(".".join(path))
+                    paths_to_load.update(
+                        ".".join(path[:i]) for i in range(1, len(path) + 1)
+                    )
+            nodes = [(root_node, [])]
+            while nodes:
+                node, path = nodes.pop()
+                for edge in graph.neighbors(node.name):
+                    next_path = path + [edge.key]
+                    full_path = ".".join(next_path)
+                    if full_path in paths_to_load:
+                        weight = node.weight * 2 if edge.backref else node.weight
+                        relations_to_load.append((edge.relationship, full_path, weight))
+                        next_node = RelationTree(
+                            edge.target, node, edge.relationship, weight
+                        )
+                        nodes.append((next_node, next_path))
+        else:
+            models_to_browse = {
+                k: v for k, v in self.session.db.models.items() if k not in exclude
+            }
+            list(
+                breadth_first_load_generator(
+                    relations_to_load,
+                    root_node,
+                    self.model_class,
+                    dict(models_to_browse),
+                    models_to_browse,
+                    max_join_depth,
+                    max_backref_depth,
+                    [],
+                    1,
+                    frozenset(),
+                    set(),
+                    graph,
+                )
+            )
+
+        return {
+            "tree": root_node.to_plan(),
+            "relations": [
+                (get_relationship_ref(relationship), path)
+                for relationship, path, weight in sorted(
+                    relations_to_load, key=lambda x: x[1]
+                )
+            ],
+            "joins": leaf_paths,
+        }
+
+
+class CacheWriter(object):
+    """Write batches of objects to the query cache file.
+
+    The rows of each batch are added to the row store of the database and
+    their keys are appended to the cache file as a frame (see
+    ``dbcut.cache``). The batches are written to a temporary file which
+    replaces the cache file and is added to the cache manifest once all
+    batches have been written, so that a cache file is never read
+    half-written and an interrupted write never looks like a valid cache
+    entry.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.count = 0
+        self.rows = 0
+        self.failed = False
+        self.file = None
+        self.writer = None
+        self.latest_values = {}
+        self.stored_values = {}
+
+    def __enter__(self):
+        db = self.query.session.db
+        self.file = AtomicFile(self.query.cache_file)
+        self.writer = ColumnarWriter(self.file.file, db.cache_codecs["queries"])
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None or self.failed:
+            self.file.discard()
+        else:
+            self.file.commit()
+            db = self.query.session.db
+            db.cache_manifest.add(
+                self.query.cache_file,
+                self.count,
+                self.rows,
+                self.writer.codec.name,
+                db.schema_fingerprint,
+                self.marks,
+            )
+
+    @property
+    def marks(self):
+        """High-water marks of the change-tracking columns of the written
+        tables (see ``CacheRefresher``).
+
+        The rows read from the row store may be older than the fetched rows,
+        so the mark of a table is never later than their own values."""
+        db = self.query.session.db
+        marks = {}
+        for table_name in set(self.latest_values) | set(self.stored_values):
+            values = [
+                value
+                for value in (
+                    self.latest_values.get(table_name),
+                    self.stored_values.get(table_name),
+                )
+                if value is not None
+            ]
+            column = db.get_tracking_column(db.tables[table_name])
+            marks[table_name] = (column.key, min(values))
+        return marks
+
+    def update_marks(self, batch):
+        db = self.query.session.db
+        for table_name, rows in batch.rows.items():
+            table = db.tables[table_name]
+            column = db.get_tracking_column(table)
+            if column is None:
+                continue
+            stored_keys = batch.stored_keys.get(table_name, ())
+            for row in rows:
+                value = row.get(column.key)
+                if value is None:
+                    continue
+                if stored_keys and get_row_key(table, row) in stored_keys:
+                    values, latest = self.stored_values, min
+                else:
+                    values, latest = self.latest_values, max
+                if table_name in values:
+                    value = latest(values[table_name], value)
+                values[table_name] = value
+
+    def write(self, objects):
+        if self.failed:
+            return
+        batch = objects
+        if not isinstance(batch, RowBatch):
+            batch = RowBatch(objects_to_rows(objects), len(objects))
+        db = self.query.session.db
+        try:
+            self.writer.write(db.row_store.store_batch(batch, db.tables))
+        except PicklingError:
+            self.failed = True
+            return
+        self.update_marks(batch)
+        self.count += len(objects)
+        self.rows += sum(len(rows) for rows in batch.rows.values())
+
+
+class CacheRefresher(object):
+    """Refresh a cached query with the rows changed in the source database
+    since it was cached, instead of fetching the whole query again.
+
+    The latest value of the change-tracking column of each table (see
+    ``Database.get_tracking_column``) is recorded in the cache manifest when
+    the query is cached. Only the cached rows whose column is at or after this
+    high-water mark are then fetched again, by key, and replaced in the row
+    store. The rows of the tables without change-tracking column (or mark) are
+    all fetched again by key.
+
+    The rows deleted from the source database are removed from the cache
+    file, along with the cached rows referencing them through a foreign key:
+    the rows whose soft delete column (``Database.soft_delete_column``) is set
+    for the tables having it, the rows whose key is not in the source database
+    anymore for the other ones (only their keys are fetched). The rows which
+    would now match the query are not added: fetch it again for that.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.db = query.session.db
+
+    def refresh(self):
+        query = self.query
+        db = self.db
+        entry = query.cache_entry
+        marks = db.cache_manifest.marks(query.cache_file)
+        with open(query.cache_file, "rb") as fd:
+            batches = list(ColumnarReader(fd))
+        keys = OrderedDict()
+        for batch in batches:
+            for table_name, key_rows in batch.rows.items():
+                table = db.tables[table_name]
+                keys.setdefault(table_name, set()).update(
+                    get_row_key(table, row) for row in key_rows
+                )
+
+        refreshed = 0
+        deleted = {}
+        for table_name, table_keys in keys.items():
+            table = db.tables[table_name]
+            column = db.get_tracking_column(table)
+            mark = marks.pop(table_name, None)
+            criterion = None
+            if column is not None and mark is not None and mark[0] == column.key:
+                criterion = column >= mark[1]
+            rows = fetch_rows_by_keys(
+                query.session, table, table_keys, query.temp_table_threshold, criterion
+            )
+            deleted_keys = self.get_deleted_keys(table, table_keys, rows, criterion)
+            changed_rows = [(k, r) for k, r in rows.items() if k not in deleted_keys]
+            db.row_store.put(table_name, changed_rows)
+            refreshed += len(changed_rows)
+            if deleted_keys:
+                deleted[table_name] = deleted_keys
+            if column is None:
+                continue
+            values = [row[column.key] for row in rows.values()]
+            if criterion is not None:
+                values.append(mark[1])
+            values = [value for value in values if value is not None]
+            if values:
+                marks[table_name] = (column.key, max(values))
+
+        self.delete_referencing_rows(keys, deleted)
+        count, rows = entry.count, entry.rows
+        if deleted:
+            count, rows = self.rewrite(batches, deleted, get_codec(entry.codec))
+        db.cache_manifest.add(
+            query.cache_file, count, rows, entry.codec, entry.fingerprint, marks
+        )
+        return RefreshResult(refreshed, sum(len(keys) for keys in deleted.values()))
+
+    def get_deleted_keys(self, table, keys, rows, criterion):
+        """Return the keys of the cached rows of ``table`` deleted from the
+        source database, ``rows`` being the fetched rows of ``keys`` matching
+        ``criterion``."""
+        soft_delete_column = self.db.soft_delete_column
+        if soft_delete_column is not None and soft_delete_column in table.columns:
+            column = table.columns[soft_delete_column].key
+            return set(
+                key for key, row in rows.items() if row[column] not in (None, False)
+            )
+        if criterion is None:
+            return keys.difference(rows)
+        existing_keys = fetch_rows_by_keys(
+            self.query.session,
+            table,
+            keys,
+            self.query.temp_table_threshold,
+            keys_only=True,
+        )
+        return keys.difference(existing_keys)
+
+    def delete_referencing_rows(self, keys, deleted):
+        """Add to ``deleted`` the cached rows referencing deleted rows through
+        a foreign key, until no other row does."""
+        db = self.db
+        while True:
+            referencing = {}
+            for table_name, table_keys in keys.items():
+                table = db.tables[table_name]
+                remaining_keys = table_keys.difference(deleted.get(table_name, ()))
+                for constraint in table.foreign_key_constraints:
+                    referred_table = constraint.referred_table
+                    referred_keys = deleted.get(referred_table.name)
+                    if not referred_keys or not remaining_keys:
+                        continue
+                    columns = dict(
+                        (element.column.key, element.parent.key)
+                        for element in constraint.elements
+                    )
+                    key_columns = [c.key for c in get_key_columns(referred_table)]
+                    if set(key_columns) != set(columns):
+                        continue
+                    rows = db.row_store.get(table_name, remaining_keys, False)
+                    for key, row in rows.items():
+                        value = tuple(row.get(columns[c]) for c in key_columns)
+                        if value in referred_keys:
+                            referencing.setdefault(table_name, set()).add(key)
+            if not referencing:
+                return deleted
+            for table_name, table_keys in referencing.items():
+                deleted.setdefault(table_name, set()).update(table_keys)
+
+    def rewrite(self, batches, deleted, codec):
+        """Write the cache file again without the ``deleted`` rows and return
+        its number of root objects and of rows."""
+        query = self.query
+        root_table_name = query.model_class.__table__.name
+        count = rows = 0
+        with AtomicFile(query.cache_file) as fd:
+            writer = ColumnarWriter(fd, codec)
+            for batch in batches:
+                batch_rows = OrderedDict()
+                batch_count = batch.count
+                for table_name, key_rows in batch.rows.items():
+                    table = self.db.tables[table_name]
+                    deleted_keys = deleted.get(table_name, ())
+                    kept_rows = [
+                        row
+                        for row in key_rows
+                        if get_row_key(table, row) not in deleted_keys
+                    ]
+                    if table_name == root_table_name:
+                        batch_count -= len(key_rows) - len(kept_rows)
+                    if kept_rows:
+                        batch_rows[table_name] = kept_rows
+                        rows += len(kept_rows)
+                if batch_rows:
+                    batch_count = max(batch_count, 0)
+                    writer.write(RowBatch(batch_rows, batch_count, batch.last_key))
+                    count += batch_count
+        return count, rows
+
 
 class QueryProperty(object):
     def __init__(self, db):
@@ -292,6 +719,27 @@ class RelationTree(object):
         if parent:
             self.parent.children.append(self)
 
+    def to_plan(self):
+        """Returns the tree as nested ``(name, relationship, weight, children)``
+        tuples, relationships being referenced by ``(model name, key)``.
+        """
+        relationship = None
+        if self.relationship is not None:
+            relationship = get_relationship_ref(self.relationship)
+        children = [child.to_plan() for child in self.children]
+        return (self.name, relationship, self.weight, children)
+
+    @classmethod
+    def from_plan(cls, plan, graph, parent=None):
+        """Builds a tree from the output of ``to_plan``."""
+        name, relationship, weight, children = plan
+        if relationship is not None:
+            relationship = graph.relationship(*relationship)
+        node = cls(name, parent, relationship, weight)
+        for child in children:
+            cls.from_plan(child, graph, node)
+        return node
+
     @cached_property
     @aslist
     def flatten(self):
@@ -323,27 +771,16 @@ def get_relationships(model):
     return sorted(values, key=lambda r: (r.direction is interfaces.MANYTOONE, r.key))
 
 
-def get_relationship_path(relationship):
-    local_table_name = relationship.parent.class_._table_info["table_name"]
-    if relationship.direction in (interfaces.ONETOMANY, interfaces.MANYTOMANY):
-        key = relationship.key
-    else:
-        key = list(relationship.local_columns)[0].name
-    return "{}.{}".format(local_table_name, key)
+def get_relationship_ref(relationship):
+    return (relationship.parent.class_.__name__, relationship.key)
 
 
-def get_relationship_reverse_path(relationship):
-    remote_table_name = relationship.target.name
-    if relationship.direction in (interfaces.ONETOMANY, interfaces.MANYTOMANY):
-        key = list(relationship.remote_side)[0].name
-    else:
-        key = relationship.back_populates
-    return "{}.{}".format(remote_table_name, key)
-
-
-def get_relationships_path(relationships):
-    path = [get_relationship_path(r) for r in relationships]
-    return path + [get_relationship_reverse_path(r) for r in relationships]
+def make_session_transient(session):
+    """Detach all the instances of ``session`` and make them transient."""
+    instances = list(session)
+    session.expunge_all()
+    for instance in instances:
+        make_transient(instance)
 
 
 STOP_BREADTH_FIRST_LOAD_GENERATOR = object()
@@ -359,43 +796,36 @@ def breadth_first_load_generator(
     backref_depth,
     path,
     weight,
-    already_seen_relationships,
+    already_seen_paths,
     already_browse_models,
+    graph,
 ):
     next_models = []
-    already_seen_relationships_path = get_relationships_path(already_seen_relationships)
     model_name = model.__name__
     if model_name in models_to_load and model_name not in already_browse_models:
-        for relationship in get_manytoone_relationships_first(model):
-            if relationship.target.name in models_to_browse:
-                relationship_path = get_relationship_path(relationship)
-                next_path = path + [relationship.key]
-                full_path = ".".join(next_path)
-                target_model = models_to_browse[relationship.target.name]
-                if relationship_path not in already_seen_relationships_path:
+        for edge in graph.neighbors(model_name):
+            if edge.target in models_to_browse:
+                if edge.path not in already_seen_paths:
                     if (
-                        relationship.direction
-                        in (interfaces.ONETOMANY, interfaces.MANYTOMANY)
+                        edge.backref
                         and (backref_depth is None or backref_depth > 0)
-                        and relationship.target.name not in already_browse_models
-                    ) or (
-                        relationship.direction is interfaces.MANYTOONE
-                        and (join_depth is None or join_depth > 0)
-                    ):
-                        if relationship.direction in (
-                            interfaces.ONETOMANY,
-                            interfaces.MANYTOMANY,
-                        ):
-                            next_weight = weight * 2
-                        else:
-                            next_weight = weight * 1
-
-                        relations_to_load.append((relationship, full_path, next_weight))
+                        and edge.target not in already_browse_models
+                    ) or (not edge.backref and (join_depth is None or join_depth > 0)):
+                        next_weight = weight * 2 if edge.backref else weight
+                        next_path = path + [edge.key]
+                        relations_to_load.append(
+                            (edge.relationship, ".".join(next_path), next_weight)
+                        )
                         next_models.append(
-                            (target_model, next_path, relationship, next_weight)
+                            (
+                                models_to_browse[edge.target],
+                                next_path,
+                                edge,
+                                next_weight,
+                            )
                         )
-            yield relationship
-        already_browse_models.append(model_name)
+            yield edge.relationship
+        already_browse_models.add(model_name)
 
     join_depth = max(0, join_depth - 1) if join_depth is not None else join_depth
     backref_depth = (
@@ -403,11 +833,11 @@ def breadth_first_load_generator(
     )
     nodes = []
 
-    for next_model, next_path, relationship, next_weight in sorted(
+    for next_model, next_path, edge, next_weight in sorted(
         next_models, key=lambda x: x[3]
     ):
         next_node = RelationTree(
-            next_model.__name__, root_node, relationship, next_weight
+            next_model.__name__, root_node, edge.relationship, next_weight
         )
         gen = breadth_first_load_generator(
             relations_to_load,
@@ -419,8 +849,9 @@ def breadth_first_load_generator(
             backref_depth,
             next_path,
             next_weight,
-            already_seen_relationships + [relationship],
+            already_seen_paths | {edge.path, edge.reverse_path},
             already_browse_models,
+            graph,
         )
         nodes.append({"generator": gen, "stop_iteration": False})
 
@@ -445,23 +876,33 @@ def breadth_first_load_generator(
     yield STOP_BREADTH_FIRST_LOAD_GENERATOR
 
 
-def get_manytoone_relationships_first(model):
-    def key(relationship):
-        if relationship.direction is interfaces.MANYTOONE:
-            return 0
-        return 1
-
-    return sorted(model.__mapper__.relationships.values(), key=key)
-
-
 def _apply_backref_limit(query, session):
     parsed_query = session.parsed_query
+    if parsed_query is None:
+        return query
+    backref_limit = parsed_query.query_dict.get("backref_limit", None)
+    if not backref_limit:
+        return query
 
-    for desc in query.column_descriptions:
-        if desc["entity"] is None and desc["name"] == "pk" and desc["type"] == Bundle:
-            # this is a selectin query
-            backref_limit = parsed_query.query_dict.get("backref_limit", None)
-            if backref_limit:
-                query = query.limit(backref_limit)
+    descriptions = query.column_descriptions
+    for desc in descriptions:
+        if (
+            desc.get("entity") is None
+            and desc["name"] == "pk"
+            and desc["type"] == Bundle
+        ):
+            # this is a selectin query, keep backref_limit children per parent
+            (entity,) = [d["entity"] for d in descriptions if d.get("entity")]
+            criterion = limit_per_parent(
+                entity.__table__,
+                desc["expr"].exprs,
+                query.whereclause,
+                backref_limit,
+                session.bind.dialect,
+            )
+            if isinstance(query, Query):
+                query = query.filter(criterion)
+            else:
+                query = query.where(criterion)
 
     return query
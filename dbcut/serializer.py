@@ -72,6 +72,31 @@ def dump_json(data, filepath):
         fd.write(to_json(data))
 
 
+class JSONListWriter(object):
+    """Incrementally serialize items as a JSON list to ``filepath``"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.encoder_cls = new_json_encoder()
+        self.fd = None
+        self.empty = True
+
+    def __enter__(self):
+        self.fd = open(self.filepath, "w", encoding="utf-8")
+        self.fd.write("[")
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.fd.write("\n]" if not self.empty else "]")
+        self.fd.close()
+
+    def write(self, items):
+        for item in items:
+            self.fd.write("\n" if self.empty else ",\n")
+            self.fd.write(to_json(item, cls=self.encoder_cls))
+            self.empty = False
+
+
 def load_json(filepath):
     """Deserialize ``filepath`` to a Python object."""
     with open(filepath, "r", encoding="utf-8") as fd:
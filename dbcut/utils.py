@@ -3,7 +3,11 @@
 import itertools
 import os
 import pickle
+import re
 import sys
+import threading
+import time
+import uuid
 import warnings
 from collections import OrderedDict
 from contextlib import contextmanager
@@ -15,6 +19,12 @@ from sqlalchemy import exc as sa_exc
 
 from .exceptions import UndefinedError
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 
 @contextmanager
 def redirect_stdout():
@@ -175,6 +185,29 @@ def aslist(generator):
     return wrapper
 
 
+def rebatch(batches, batch_size=None):
+    """Regroup an iterable of batches into batches of ``batch_size`` items.
+
+    Examples::
+
+    >>> list(rebatch([[1, 2, 3], [4], [5, 6]], 2))
+    [[1, 2], [3, 4], [5, 6]]
+    >>> list(rebatch([[1, 2], [3]]))
+    [[1, 2, 3]]
+    >>> list(rebatch([]))
+    []
+    """
+    batch = []
+    for items in batches:
+        for item in items:
+            batch.append(item)
+            if batch_size and len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
 def create_directory(dir_path):
     absolute_dir_path = os.path.realpath(
         os.path.join(os.getcwd(), os.path.expanduser(dir_path))
@@ -184,6 +217,109 @@ def create_directory(dir_path):
     return absolute_dir_path
 
 
+class AtomicFile(object):
+    """A temporary file next to ``path`` which replaces ``path`` once
+    committed, so that ``path`` is never seen half-written.
+
+    Used as a context manager, the file is committed if no exception is
+    raised and discarded otherwise.
+    """
+
+    def __init__(self, path, mode="wb"):
+        self.path = path
+        self.temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        # unlike mkstemp, the permissions follow the umask as for ``open``
+        fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        self.file = os.fdopen(fd, mode)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class FileLock(object):
+    """Exclusive lock of the file ``path`` (created if needed), shared by the
+    threads and the processes using it.
+
+    ``acquire`` waits for the lock held by other threads or processes, or
+    returns False without waiting if ``blocking`` is False. The lock is not
+    reentrant.
+    """
+
+    _thread_locks = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.fd = None
+        self.thread_lock = None
+
+    @property
+    def acquired(self):
+        return self.thread_lock is not None
+
+    def acquire(self, blocking=True):
+        # threads of the same process share the lock of the file descriptor
+        # of the process, so they first wait for each other
+        with FileLock._thread_locks_lock:
+            thread_lock = FileLock._thread_locks.setdefault(self.path, threading.Lock())
+        if not thread_lock.acquire(blocking):
+            return False
+        self.thread_lock = thread_lock
+        try:
+            self.fd = open(self.path, "a+b")
+            if fcntl is not None:
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                try:
+                    fcntl.flock(self.fd.fileno(), flags)
+                except BlockingIOError:
+                    self.release()
+                    return False
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(self.fd.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            self.release()
+                            return False
+                        time.sleep(0.1)
+        except BaseException:
+            self.release()
+            raise
+        return True
+
+    def release(self):
+        if not self.acquired:
+            return
+        if self.fd is not None:
+            # closing the file releases the lock
+            self.fd.close()
+            self.fd = None
+        thread_lock, self.thread_lock = self.thread_lock, None
+        thread_lock.release()
+
+    def __del__(self):
+        self.release()
+
+
 class VoidObject(object):
     def __init__(*args, **kwargs):
         pass
@@ -266,6 +402,34 @@ def get_directory_size(directory):
     return directory_size / (1024 * 1024.0)
 
 
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    """Parse a number of bytes such as ``5GB``, ``500 MB`` or ``1024``."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*$", value, re.I)
+    if match is None:
+        raise ValueError("Invalid size: %r" % value)
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value):
+    """Parse a number of seconds such as ``12h``, ``7d``, ``30 m`` or ``60``."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$", value, re.I)
+    if match is None:
+        raise ValueError("Invalid duration: %r" % value)
+    number, unit = match.groups()
+    return float(number) * _DURATION_UNITS[unit.lower()]
+
+
 def expand_env_variables(content):
     t = Template(content)
     try:
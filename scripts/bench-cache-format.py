@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the query cache format.
+
+Builds a SQLite database with ``--parents`` parents having ``--children``
+children each, fetches them as ORM objects and compares writing and reading
+them back as rows with the previous format (``sqlalchemy.ext.serializer``
+pickles of the objects graphs, flattened into rows after loading) and with the
+columnar format of ``dbcut.cache``.
+"""
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy.orm import selectinload
+
+from dbcut.cache import ColumnarReader, ColumnarWriter
+from dbcut.database import Database
+from dbcut.extractor import RowBatch
+from dbcut.loader import objects_to_rows
+
+
+def create_database(path, parents, children):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE parent (id INTEGER PRIMARY KEY, name TEXT, created DATETIME);
+        CREATE TABLE child (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            score FLOAT,
+            parent_id INTEGER REFERENCES parent(id)
+        );
+        """
+    )
+    conn.executemany(
+        "INSERT INTO parent VALUES (?, ?, ?)",
+        (
+            (i, "parent %d" % i, "2021-04-13 10:00:%02d" % (i % 60))
+            for i in range(parents)
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO child VALUES (?, ?, ?, ?)",
+        (
+            (i, "child %d" % i, i / 7.0, i // children)
+            for i in range(parents * children)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--parents", type=int, default=5000)
+    parser.add_argument("--children", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "bench.db")
+        create_database(path, args.parents, args.children)
+        db = Database(uri="sqlite:///%s" % path, cache_dir=tmpdir, enable_cache=False)
+        db.reflect()
+        model = db.models["parent"]
+        (relationship,) = model.__mapper__.relationships
+        query = db.session.query(model).options(
+            selectinload(getattr(model, relationship.key))
+        )
+        objects = list(query.transient_objects(query.all()))
+        batches = [
+            objects[i : i + args.batch_size]
+            for i in range(0, len(objects), args.batch_size)
+        ]
+
+        def write_pickle():
+            return b"".join(sa_serializer.dumps(batch) for batch in batches)
+
+        def read_pickle():
+            fd = io.BytesIO(content)
+            rows = 0
+            for _ in batches:
+                batch = sa_serializer.Deserializer(fd, db.metadata, db.session).load()
+                rows += sum(len(r) for r in objects_to_rows(batch).values())
+            return rows
+
+        def write_columnar():
+            fd = io.BytesIO()
+            writer = ColumnarWriter(fd)
+            for batch in batches:
+                writer.write(RowBatch(objects_to_rows(batch), len(batch)))
+            return fd.getvalue()
+
+        def read_columnar():
+            reader = ColumnarReader(io.BytesIO(content))
+            return sum(len(r) for b in reader for r in b.rows.values())
+
+        print("%-10s %12s %12s %12s" % ("format", "size (MB)", "write (s)", "read (s)"))
+        for name, write, read in (
+            ("pickle", write_pickle, read_pickle),
+            ("columnar", write_columnar, read_columnar),
+        ):
+            content, write_elapsed = timeit(write)
+            rows, read_elapsed = timeit(read)
+            db.session.expunge_all()
+            print(
+                "%-10s %12.2f %12.3f %12.3f  (%d rows)"
+                % (name, len(content) / 1e6, write_elapsed, read_elapsed, rows)
+            )
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the construction of relation trees (BaseQuery.with_loaded_relations).
+
+Builds a synthetic SQLite schema of ``--tables`` tables, each one having
+``--fks`` foreign keys to random other tables, and measures the time needed to
+build the relation tree of queries starting from several tables, with the
+default depths and with ``include``, then again once their relation plans have
+been cached.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy.orm import configure_mappers
+
+from dbcut.configuration import DEFAULT_CONFIG
+from dbcut.database import Database
+from dbcut.parser import parse_query
+
+
+def create_database(path, tables, fks, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    for i in range(tables):
+        columns = ["id INTEGER PRIMARY KEY", "name TEXT"]
+        targets = sorted(set(rng.randrange(tables) for _ in range(fks)) - {i})
+        for target in targets:
+            columns.append("t%d_id INTEGER REFERENCES t%d(id)" % (target, target))
+        conn.execute("CREATE TABLE t%d (%s)" % (i, ", ".join(columns)))
+    conn.commit()
+    conn.close()
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--tables", type=int, default=1000)
+    parser.add_argument("--fks", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    # reflecting long chains of foreign keys is recursive
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), args.tables * 20))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "bench.db")
+        create_database(path, args.tables, args.fks, args.seed)
+        db = Database(uri="sqlite:///%s" % path, cache_dir=tmpdir, enable_cache=False)
+
+        start = time.perf_counter()
+        db.reflect()
+        print("%-28s %10.3f s" % ("reflect", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        configure_mappers()
+        print("%-28s %10.3f s" % ("configure mappers", time.perf_counter() - start))
+
+        rng = random.Random(args.seed)
+        roots = ["t%d" % rng.randrange(args.tables) for _ in range(args.queries)]
+        includes = ["t%d" % rng.randrange(args.tables) for _ in range(5)]
+        scenarios = [
+            ("default depths", lambda root: {"from": root}),
+            (
+                "include (5 tables)",
+                lambda root: {"from": root, "include": includes},
+            ),
+            # same queries again: the relation plans are cached by the database
+            ("default depths (cached)", lambda root: {"from": root}),
+        ]
+        for name, make_query_dict in scenarios:
+            nodes = 0
+            start = time.perf_counter()
+            for root in roots:
+                query = parse_query(make_query_dict(root), db.session, DEFAULT_CONFIG)
+                nodes += len(query.relation_tree.flatten)
+            elapsed = time.perf_counter() - start
+            print(
+                "%-28s %10.3f s  (%.1f ms/query, %d nodes)"
+                % (name, elapsed, elapsed * 1000 / len(roots), nodes)
+            )
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
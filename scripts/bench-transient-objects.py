@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmark the detachment of fetched objects (BaseQuery.transient_objects).
+
+Builds a SQLite database with ``N`` parents having ``--children`` children each
+and measures the time needed to detach all fetched objects for growing values
+of ``N``. The detach time per object must stay roughly constant.
+"""
+from __future__ import print_function, unicode_literals
+
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from sqlalchemy.orm import selectinload
+
+from dbcut.database import Database
+
+
+def create_database(path, parents, children):
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE parent (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE child (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            parent_id INTEGER REFERENCES parent(id)
+        );
+        """
+    )
+    conn.executemany(
+        "INSERT INTO parent VALUES (?, ?)",
+        ((i, "parent %d" % i) for i in range(parents)),
+    )
+    conn.executemany(
+        "INSERT INTO child VALUES (?, ?, ?)",
+        ((i, "child %d" % i, i // children) for i in range(parents * children)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def run(tmpdir, parents, children):
+    path = os.path.join(tmpdir, "bench-%d.db" % parents)
+    create_database(path, parents, children)
+    db = Database(uri="sqlite:///%s" % path, cache_dir=tmpdir, enable_cache=False)
+    db.reflect()
+    model = db.models["parent"]
+    (relationship,) = model.__mapper__.relationships
+    query = db.session.query(model).options(
+        selectinload(getattr(model, relationship.key))
+    )
+
+    start = time.perf_counter()
+    objects = query.all()
+    load_elapsed = time.perf_counter() - start
+
+    gc.collect()
+    start = time.perf_counter()
+    objects = list(query.transient_objects(objects))
+    detach_elapsed = time.perf_counter() - start
+
+    total = len(objects) * (children + 1)
+    db.close()
+    return total, load_elapsed, detach_elapsed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--children", type=int, default=10)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1000, 2000, 4000, 8000, 16000]
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print(
+            "%10s %12s %12s %12s %16s"
+            % ("parents", "objects", "load (s)", "detach (s)", "detach us/object")
+        )
+        for parents in args.sizes:
+            total, load_elapsed, detach_elapsed = run(tmpdir, parents, args.children)
+            print(
+                "%10d %12d %12.3f %12.3f %16.2f"
+                % (
+                    parents,
+                    total,
+                    load_elapsed,
+                    detach_elapsed,
+                    detach_elapsed * 1e6 / total,
+                )
+            )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import datetime
+import decimal
+import io
+import sqlite3
+from collections import OrderedDict
+
+import pytest
+
+from dbcut import extractor
+from dbcut.cache import ColumnarReader, ColumnarWriter, decode_column, encode_column
+from dbcut.cli.operations import ObjectsGenerator
+from dbcut.database import Database
+from dbcut.extractor import RowBatch
+from dbcut.loader import objects_to_rows
+from dbcut.utils import FileLock
+
+from .test_extractor import make_database, parse
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        [1, None, 2 ** 63 - 1, -(2 ** 63)],
+        [2 ** 64, 1],
+        [1.5, None, -0.0],
+        [True, None, False],
+        ["héllo", None, "", "\udcff"],
+        [b"a\x00", None, b""],
+        [None, None],
+        [datetime.date(2021, 4, 13), None, decimal.Decimal("1.20")],
+        [True, 1],
+        [],
+    ],
+)
+def test_columns_keep_their_values_and_types(values):
+    decoded = decode_column(encode_column(values))
+    assert decoded == values
+    assert [type(v) for v in decoded] == [type(v) for v in values]
+
+
+def test_batches_are_read_back_as_rows():
+    rows = OrderedDict(
+        [
+            ("book", [{"id": 1, "title": "a"}, {"id": 2, "title": None}, {"id": 3}]),
+            ("author", [{"id": 1, "name": "b"}]),
+        ]
+    )
+    fd = io.BytesIO()
+    writer = ColumnarWriter(fd)
+    writer.write(RowBatch(rows, 3, (3,)))
+    writer.write(RowBatch(OrderedDict(), 0))
+    fd.seek(0)
+    first, second = list(ColumnarReader(fd))
+    assert (first.rows, first.count, first.last_key) == (rows, 3, (3,))
+    assert (second.rows, second.count) == ({}, 0)
+
+    with pytest.raises(ValueError):
+        ColumnarReader(io.BytesIO(b"not a cache file"))
+
+
+def test_cached_query_is_loaded_without_the_orm(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    query = parse(db, **{"from": "author", "limit": 4})
+    assert not query.is_cached
+    expected = list(query.iter_batches(3))
+    with query.cache_writer() as writer:
+        for batch in expected:
+            writer.write(batch)
+    assert query.is_cached
+
+    count, batches = query.load_from_cache()
+    batches = list(batches)
+    assert count == 4
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert [batch.rows for batch in batches] == [
+        objects_to_rows(batch) for batch in expected
+    ]
+    db.close()
+
+
+def test_cache_lock_is_released_by_the_batches_of_the_query(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    query = parse(db, **{"from": "author", "limit": 4})
+    lock = query.cache_lock()
+
+    # never iterated (skipped query)
+    assert lock.acquire()
+    ObjectsGenerator(query, query.iter_batches(3), lock).close()
+    assert not lock.acquired
+    assert not query.is_cached
+
+    assert lock.acquire()
+    batches = ObjectsGenerator(query, query.iter_batches(3), lock)
+    assert not FileLock(lock.path).acquire(blocking=False)
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert not lock.acquired
+    assert query.is_cached
+    db.close()
+
+
+def test_rows_are_stored_once_and_shared_by_queries(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    first = parse(db, **{"from": "author", "limit": 4})
+    with first.cache_writer() as writer:
+        for batch in first.iter_batches(3):
+            writer.write(batch)
+    stored = db.row_store.connection.execute(
+        "SELECT table_name, COUNT(*) FROM rows GROUP BY table_name"
+    )
+    assert dict(stored) == {"author": 4, "book": 12, "book_tag": 20, "tag": 5}
+
+    fetched = {}
+
+    def fetch_rows_by_keys(session, table, keys, temp_table_threshold=None):
+        fetched[table.name] = sorted(keys)
+        return original(session, table, keys, temp_table_threshold)
+
+    original = extractor.fetch_rows_by_keys
+    monkeypatch.setattr(extractor, "fetch_rows_by_keys", fetch_rows_by_keys)
+    second = parse(db, **{"from": "author", "limit": 5})
+    second.engine = "core"
+    second.row_store = db.row_store
+    (batch,) = list(second.iter_batches(10))
+    # only the rows of the new author and of its books are fetched
+    assert fetched["author"] == [(5,)]
+    assert len(fetched["book"]) == 3
+    assert "tag" not in fetched
+
+    second.row_store = None
+    (expected,) = list(second.iter_batches(10))
+    assert batch.rows == expected.rows
+    db.close()
+
+
+def test_missing_stored_rows_are_fetched_again(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    query = parse(db, **{"from": "book", "limit": 10})
+    query.save_to_cache()
+    with db.row_store.connection as connection:
+        connection.execute("DELETE FROM rows WHERE table_name = 'author'")
+
+    count, batches = query.load_from_cache()
+    (batch,) = list(batches)
+    assert count == 10
+    assert batch.rows == objects_to_rows(list(query.objects()))
+    assert db.row_store.get("author", [(0,), (9,)]) == {
+        (0,): {"id": 0, "name": "author 0"},
+        (9,): {"id": 9, "name": "author 9"},
+    }
+    db.close()
+
+
+def test_cached_query_is_refreshed_with_the_changed_rows(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    conn = sqlite3.connect("src.db")
+    conn.executescript(
+        """
+        ALTER TABLE author ADD COLUMN deleted BOOLEAN NOT NULL DEFAULT 0;
+        ALTER TABLE book ADD COLUMN modified INTEGER;
+        UPDATE book SET modified = id;
+        """
+    )
+    conn.commit()
+    db = Database(
+        uri="sqlite:///src.db",
+        cache_dir="cache",
+        enable_cache=False,
+        soft_delete_column="deleted",
+    )
+    db.reflect()
+    query = parse(db, **{"from": "author", "limit": 4})
+    query.save_to_cache()
+    assert db.cache_manifest.marks(query.cache_file) == {"book": ("modified", 29)}
+
+    conn.executescript(
+        """
+        UPDATE book SET title = 'changed', modified = 100 WHERE id = 29;
+        UPDATE book SET title = 'not tracked' WHERE id = 27;
+        UPDATE author SET deleted = 1 WHERE id = 8;
+        DELETE FROM book_tag WHERE book_id = 29 AND tag_id = 1;
+        """
+    )
+    conn.commit()
+    conn.close()
+    refreshed, deleted = query.refresh_cache()
+    # author 8, its 3 books and their 5 tags, and the deleted book tag
+    assert deleted == 1 + 3 + 5 + 1
+    assert db.cache_manifest.marks(query.cache_file) == {"book": ("modified", 100)}
+
+    count, batches = query.load_from_cache()
+    rows = {}
+    for batch in batches:
+        for table_name, table_rows in batch.rows.items():
+            rows.setdefault(table_name, {}).update(
+                (row["id"], row) for row in table_rows if "id" in row
+            )
+    assert count == 3
+    assert sorted(rows["author"]) == [6, 7, 9]
+    assert sorted(rows["book"]) == [6, 7, 9, 16, 17, 19, 26, 27, 29]
+    assert rows["book"][29]["title"] == "changed"
+    # rows changed without their change-tracking column are not refreshed
+    assert rows["book"][27]["title"] == "book 27"
+    db.close()
+
+
+def test_cached_metadata_is_patched_with_the_changed_tables(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    assert db.changed_tables == []
+    db.close()
+
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    assert db.changed_tables == []
+    db.close()
+
+    conn = sqlite3.connect("src.db")
+    conn.executescript(
+        """
+        ALTER TABLE book ADD COLUMN modified INTEGER;
+        CREATE TABLE review (
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER REFERENCES book(id)
+        );
+        DROP TABLE book_tag;
+        """
+    )
+    conn.commit()
+    conn.close()
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    assert db.changed_tables == ["book", "book_tag", "review"]
+    assert sorted(db.tables) == ["author", "book", "review", "tag"]
+    assert "modified" in db.tables["book"].columns
+    assert db.tables["review"].c.book_id.references(db.tables["book"].c.id)
+    assert db.tables["book"].c.author_id.references(db.tables["author"].c.id)
+    fresh = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    fresh.reflect()
+    for name, model in fresh.models.items():
+        assert sorted(db.models[name].__mapper__.relationships.keys()) == sorted(
+            model.__mapper__.relationships.keys()
+        )
+    assert db.schema_fingerprint == fresh.schema_fingerprint
+    fresh.close()
+    db.close()
+
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    assert db.changed_tables == []
+    assert "modified" in db.tables["book"].columns
+    db.close()
+
+
+def test_stored_rows_of_changed_tables_are_dropped(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    query = parse(db, **{"from": "author", "limit": 2})
+    query.save_to_cache()
+    db.close()
+
+    conn = sqlite3.connect("src.db")
+    conn.executescript("ALTER TABLE author ADD COLUMN email TEXT DEFAULT 'a@b.c';")
+    conn.commit()
+    conn.close()
+    db = Database(uri="sqlite:///src.db", cache_dir="cache", enable_cache=False)
+    db.reflect()
+    assert db.row_store.get("author", [(8,), (9,)]) == {}
+    assert len(db.row_store.get("book", [(8,), (9,)])) == 2
+
+    query = parse(db, **{"from": "author", "limit": 2})
+    query.engine = "core"
+    query.row_store = db.row_store
+    (batch,) = list(query.iter_batches(10))
+    assert [row["email"] for row in batch.rows["author"]] == ["a@b.c", "a@b.c"]
+    db.close()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
+import sqlite3
+
 from click.testing import CliRunner
 
 from dbcut.cli.main import main
 
+from .test_extractor import make_database
+
 DEFAULT_YML = """
 cache: .cache/dbcut
 
@@ -136,6 +140,65 @@ def test_load_mysql_to_postgres():
     do_cmd_test(mysql_postgres_databases, "load")
 
 
+def test_load_parallel_mysql_to_sqlite():
+    do_cmd_test(mysql_sqlite_databases, "load", "--jobs", "4", "--batch-size", "5")
+
+
+def test_load_parallel_sqlite_to_sqlite_matches_sequential_load(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    queries = """
+queries:
+  - from: author
+    limit: 4
+  - from: book
+    limit: 30
+    backref_depth: 0
+  - from: tag
+  - from: book
+    where:
+      author_id: 3
+  - from: author
+    offset: 2
+    limit: 3
+"""
+    runner = CliRunner()
+    contents = []
+    for jobs in ("1", "4"):
+        with open("dbcut.yml", "w") as f:
+            f.write(
+                "databases:\n"
+                "  source_uri: sqlite:///src.db\n"
+                "  destination_uri: sqlite:///dest-%s.db\n" % jobs
+            )
+            f.write(queries)
+        do_invoke_test(
+            runner,
+            main,
+            ["-y", "load", "--no-cache", "--jobs", jobs, "--batch-size", "2"],
+        )
+        conn = sqlite3.connect("dest-%s.db" % jobs)
+        contents.append(
+            {
+                table: conn.execute(
+                    "SELECT * FROM %s ORDER BY rowid" % table
+                ).fetchall()
+                for table in ("author", "book", "tag", "book_tag")
+            }
+        )
+        conn.close()
+    assert contents[0]["book"]
+    assert contents[1] == contents[0]
+
+
+def test_load_plan_mysql_to_sqlite():
+    do_cmd_test(mysql_sqlite_databases, "load", "--plan")
+
+
+def test_load_core_engine_mysql_to_sqlite():
+    do_cmd_test(mysql_sqlite_databases, "load", "--engine", "core")
+
+
 def test_dumpjson_mysql_to_mysql():
     do_cmd_test(mysql_mysql_databases, "dumpjson")
 
@@ -198,6 +261,19 @@ def test_loading_cache():
         do_invoke_test(runner, main, ["-y", "purgecache"])
 
 
+def test_warmcache():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open("dbcut.yml", "w") as f:
+            f.write(mysql_sqlite_databases)
+            f.write(DEFAULT_YML)
+
+        do_invoke_test(runner, main, ["-y", "warmcache", "--jobs", "4"])
+        do_invoke_test(runner, main, ["-y", "warmcache", "--max-age", "1d"])
+        do_invoke_test(runner, main, ["-y", "load"])
+        do_invoke_test(runner, main, ["-y", "purgecache"])
+
+
 def test_multiple_cmd_mysql_to_mysql():
     runner = CliRunner()
     with runner.isolated_filesystem():
@@ -0,0 +1,74 @@
+import io
+import os
+from collections import OrderedDict
+
+import pytest
+
+from dbcut.cache import ColumnarReader, ColumnarWriter
+from dbcut.compression import (
+    CODECS,
+    get_cache_codecs,
+    read_compressed,
+    write_compressed,
+)
+from dbcut.database import Database
+from dbcut.extractor import RowBatch
+
+from .test_extractor import make_database, parse
+
+
+@pytest.mark.parametrize("name", list(CODECS))
+def test_cache_files_are_read_whatever_their_codec(name):
+    rows = OrderedDict([("book", [{"id": i, "title": "book"} for i in range(100)])])
+    fd = io.BytesIO()
+    ColumnarWriter(fd, CODECS[name]).write(RowBatch(rows, 100, (99,)))
+    fd.seek(0)
+    (batch,) = list(ColumnarReader(fd))
+    assert batch.rows == rows
+
+    fd = io.BytesIO()
+    write_compressed(fd, b"data" * 100, CODECS[name])
+    fd.seek(0)
+    assert read_compressed(fd) == b"data" * 100
+    assert read_compressed(io.BytesIO(b"uncompressed")) == b"uncompressed"
+
+
+def test_codec_is_chosen_per_cache():
+    codecs = get_cache_codecs("zlib")
+    assert set(codec.name for codec in codecs.values()) == {"zlib"}
+    codecs = get_cache_codecs({"queries": "lzma", "rows": "bz2"})
+    assert [codecs[c].name for c in ("queries", "rows", "metadata")] == [
+        "lzma",
+        "bz2",
+        "none",
+    ]
+    with pytest.raises(ValueError):
+        get_cache_codecs("unknown")
+    with pytest.raises(ValueError):
+        get_cache_codecs({"unknown": "zlib"})
+
+
+def test_compressed_caches_are_read_back(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    compression = {"queries": "lzma", "rows": "zlib", "metadata": "bz2"}
+    db = Database(
+        uri="sqlite:///src.db", cache_dir="cache", cache_compression=compression
+    )
+    db.reflect()
+    query = parse(db, **{"from": "book", "limit": 10})
+    query.save_to_cache()
+    expected = list(query.load_from_cache()[1])
+    db.close()
+    with open(db.cached_metadata_path, "rb") as fd:
+        assert fd.read().startswith(b"DBCUT-COMPRESSED:bz2\n")
+
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    assert db.cached_metadata is not None
+    db.reflect()
+    query = parse(db, **{"from": "book", "limit": 10})
+    assert query.is_cached
+    batches = list(query.load_from_cache()[1])
+    assert [batch.rows for batch in batches] == [batch.rows for batch in expected]
+    assert os.path.exists(db.row_store_path)
+    db.close()
@@ -0,0 +1,253 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.orm import object_session
+
+from dbcut import extractor
+from dbcut.compiler import Explain
+from dbcut.configuration import DEFAULT_CONFIG
+from dbcut.database import Database
+from dbcut.extractor import (
+    ExtractionPlan,
+    RelationWalker,
+    RowBatch,
+    estimate_row_count,
+    get_row_key,
+)
+from dbcut.loader import objects_to_rows
+from dbcut.parser import parse_query
+
+
+def make_database(tmpdir):
+    path = str(tmpdir.join("src.db"))
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE author (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE book (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            author_id INTEGER REFERENCES author(id)
+        );
+        CREATE TABLE tag (id INTEGER PRIMARY KEY, label TEXT);
+        CREATE TABLE book_tag (
+            book_id INTEGER REFERENCES book(id),
+            tag_id INTEGER REFERENCES tag(id),
+            PRIMARY KEY (book_id, tag_id)
+        );
+        """
+    )
+    conn.executemany(
+        "INSERT INTO author VALUES (?, ?)", ((i, "author %d" % i) for i in range(10))
+    )
+    conn.executemany(
+        "INSERT INTO book VALUES (?, ?, ?)",
+        ((i, "book %d" % i, i % 10) for i in range(100)),
+    )
+    conn.executemany(
+        "INSERT INTO tag VALUES (?, ?)", ((i, "tag %d" % i) for i in range(5))
+    )
+    conn.executemany(
+        "INSERT INTO book_tag VALUES (?, ?)",
+        ((i, j) for i in range(100) for j in range(5) if (i + j) % 3 == 0),
+    )
+    conn.commit()
+    conn.close()
+    db = Database(uri="sqlite:///%s" % path, cache_dir=str(tmpdir), enable_cache=False)
+    db.reflect()
+    return db
+
+
+def parse(db, **query_dict):
+    config = dict(DEFAULT_CONFIG, default_backref_limit=3)
+    return parse_query(query_dict, db.session, config)
+
+
+def test_walker_fetches_the_rows_of_the_orm_query(tmpdir):
+    db = make_database(tmpdir)
+    for query_dict in ({"from": "author"}, {"from": "tag"}, {"from": "book"}):
+        query = parse(db, **query_dict)
+        expected = {
+            table_name: {get_row_key(db.tables[table_name], r): dict(r) for r in rows}
+            for table_name, rows in objects_to_rows(query.all()).items()
+        }
+        rows = {
+            table_name: {key: dict(r) for key, r in table_rows.items()}
+            for table_name, table_rows in RelationWalker(query).walk().items()
+        }
+        assert rows == expected
+    db.close()
+
+
+def test_plan_merges_the_keys_of_the_queries(tmpdir):
+    db = make_database(tmpdir)
+    plan = ExtractionPlan(db)
+    plan.add_query(parse(db, **{"from": "book", "limit": 5}))
+    plan.add_query(parse(db, **{"from": "book", "limit": 10}))
+    assert plan.count("book") == 10
+    assert plan.count("author") == 10
+    rows = [row for batch in plan.iter_rows("book", 4) for row in batch]
+    assert sorted(row["id"] for row in rows) == list(range(90, 100))
+    assert rows[0] == {"id": 90, "title": "book 90", "author_id": 0}
+    db.close()
+
+
+def test_core_engine_fetches_batches_of_rows(tmpdir):
+    db = make_database(tmpdir)
+    query = parse(db, **{"from": "author"})
+    query.engine = "core"
+    batches = list(query.iter_batches(4))
+    assert all(isinstance(batch, RowBatch) for batch in batches)
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    authors = [row["id"] for batch in batches for row in batch.rows["author"]]
+    assert sorted(authors) == list(range(10))
+    db.close()
+
+
+def test_large_key_sets_are_joined_from_a_temporary_table(tmpdir):
+    db = make_database(tmpdir)
+    statements = []
+    event.listen(
+        db.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    query = parse(db, **{"from": "tag", "limit": None})
+
+    def walk(threshold):
+        walker = RelationWalker(query, temp_table_threshold=threshold)
+        return {name: dict(rows) for name, rows in walker.walk().items()}
+
+    rows = walk(None)
+    assert not any("dbcut_keys" in statement for statement in statements)
+    assert walk(1) == rows
+    assert any("JOIN dbcut_keys" in statement for statement in statements)
+    db.close()
+
+
+def test_batches_are_paginated_on_the_primary_key(tmpdir):
+    db = make_database(tmpdir)
+    statements = []
+    event.listen(
+        db.engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    for engine in ("orm", "core"):
+        query = parse(db, **{"from": "book", "offset": 5, "limit": 12})
+        query.engine = engine
+        batches = list(query.iter_batches(5))
+        assert [len(batch) for batch in batches] == [5, 5, 2]
+        assert [query.get_last_key(batch) for batch in batches] == [
+            (90,),
+            (85,),
+            (83,),
+        ]
+    assert any("book.id < ?" in statement for statement in statements)
+    db.close()
+
+
+def test_transient_objects_keep_their_loaded_relations(tmpdir):
+    db = make_database(tmpdir)
+    query = parse(db, **{"from": "book", "limit": 3})
+    books = list(query.transient_objects())
+    assert len(books) == 3
+    assert len(db.session.identity_map) == 0
+
+    seen = set()
+    pending = list(books)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        state = inspect(obj)
+        assert state.transient
+        assert object_session(obj) is None
+        for relationship in state.mapper.relationships:
+            # only the loaded relations are in the dict of the instance
+            value = state.dict.get(relationship.key)
+            if isinstance(value, list):
+                pending.extend(value)
+            elif value is not None:
+                pending.append(value)
+
+    for book in books:
+        assert "author" in inspect(book).dict
+        assert book.author.id == book.author_id
+        assert "book_tag_collection" in inspect(book).dict
+    # the related objects of the books are reached too
+    assert len(seen) > len(books)
+    db.close()
+
+
+@pytest.mark.parametrize("order_by", [None, "title"])
+def test_batches_hold_the_rows_of_the_unbatched_query(tmpdir, order_by):
+    db = make_database(tmpdir)
+    query_dict = {"from": "book", "limit": 23}
+    if order_by is not None:
+        # windows with an OFFSET instead of the keyset pagination
+        query_dict["order_by"] = order_by
+
+    def rows_by_key(batches):
+        rows = {}
+        for batch in batches:
+            for table_name, table_rows in objects_to_rows(batch).items():
+                table = db.tables[table_name]
+                rows.setdefault(table_name, {}).update(
+                    (get_row_key(table, row), row) for row in table_rows
+                )
+        return rows
+
+    expected = rows_by_key(parse(db, **query_dict).iter_batches())
+    query = parse(db, **query_dict)
+    assert (query.keyset_columns is None) == (order_by is not None)
+    batches = []
+    for batch in query.iter_batches(4):
+        assert len(batch) <= 4
+        # each batch is expunged from the source session once fetched
+        assert len(db.session.identity_map) == 0
+        assert all(object_session(obj) is None for obj in batch)
+        batches.append(batch)
+    assert [len(batch) for batch in batches] == [4, 4, 4, 4, 4, 3]
+    assert rows_by_key(batches) == expected
+    db.close()
+
+
+@pytest.mark.parametrize("window_functions", [True, False])
+def test_backref_limit_is_applied_per_parent(tmpdir, monkeypatch, window_functions):
+    monkeypatch.setattr(
+        extractor, "supports_window_functions", lambda dialect: window_functions
+    )
+    db = make_database(tmpdir)
+    expected = sorted(a + 10 * i for a in range(10) for i in range(3))
+    for engine in ("orm", "core"):
+        query = parse(db, **{"from": "author"})
+        query.engine = engine
+        (batch,) = query.iter_batches()
+        if engine == "core":
+            rows = batch.rows["book"]
+        else:
+            rows = objects_to_rows(batch)["book"]
+        assert sorted(row["id"] for row in rows) == expected
+    db.close()
+
+
+def test_count_can_be_estimated_or_skipped(tmpdir):
+    db = make_database(tmpdir)
+    query = parse(db, **{"from": "book", "limit": 20})
+    statement = query.enable_eagerloads(False).statement
+    assert str(Explain(statement).compile(dialect=postgresql.dialect())).startswith(
+        "EXPLAIN (FORMAT JSON) SELECT"
+    )
+    assert str(Explain(statement).compile(dialect=mysql.dialect())).startswith(
+        "EXPLAIN SELECT"
+    )
+    # SQLite has no row estimates, the objects are counted instead
+    assert estimate_row_count(db.session.connection(), statement) is None
+    assert query.prefetch_count("exact") == 20
+    assert query.prefetch_count("estimate") == 20
+    assert query.prefetch_count("none") is None
+    db.close()
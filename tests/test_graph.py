@@ -0,0 +1,99 @@
+import os
+
+from dbcut import query as query_module
+from dbcut.database import Database
+from dbcut.graph import SchemaGraph
+
+from .test_extractor import make_database, parse
+
+
+def test_schema_graph_lists_manytoone_relationships_first(tmpdir):
+    db = make_database(tmpdir)
+    graph = db.schema_graph
+    assert isinstance(graph, SchemaGraph)
+    assert len(graph) == 3
+    assert [(e.target, e.backref) for e in graph.neighbors("book")] == [
+        ("author", False),
+        ("tag", True),
+    ]
+    author = graph.neighbors("book")[0]
+    assert author.path == "book.author_id"
+    assert author.reverse_path == "author.author_book_collection"
+    assert graph.neighbors("unknown") == ()
+    db.close()
+
+
+def test_relation_tree_is_built_from_the_schema_graph(tmpdir):
+    db = make_database(tmpdir)
+    assert parse(db, **{"from": "author"}).relation_tree.flatten == [
+        "author",
+        "book",
+        "tag",
+    ]
+    assert parse(db, **{"from": "book", "backref_depth": 0}).relation_tree.flatten == [
+        "book",
+        "author",
+    ]
+    query = parse(db, **{"from": "tag", "exclude": ["author"]})
+    assert query.relation_tree.flatten == ["tag", "book"]
+    db.close()
+
+
+def test_include_loads_the_lightest_paths(tmpdir):
+    db = make_database(tmpdir)
+    paths = db.schema_graph.shortest_paths("tag")
+    assert [edge.key for edge in paths.edges("author")] == [
+        "tag_book_collection",
+        "author",
+    ]
+    assert "author" not in db.schema_graph.shortest_paths("tag", exclude=["book"])
+
+    query = parse(db, **{"from": "tag", "include": ["author", "book"]})
+    assert query.relation_tree.flatten == ["tag", "book", "author"]
+    assert [n.weight for n in query.relation_tree.children[0].children] == [2]
+    assert "JOIN book" in str(query.statement)
+    assert "JOIN author" in str(query.statement)
+    db.close()
+
+
+def test_relation_plans_are_reused_from_the_cache_directory(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    query = parse(db, **{"from": "book", "include": ["tag"]})
+    expected = (query.relation_tree.render(return_value=True), str(query.statement))
+    # saved once on close
+    assert not os.path.exists(db.cached_relation_plans_path)
+    db.close()
+    assert os.path.exists(db.cached_relation_plans_path)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the schema graph must not be walked")
+
+    monkeypatch.setattr(query_module, "breadth_first_load_generator", fail)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    query = parse(db, **{"from": "book", "include": ["tag"]})
+    assert (query.relation_tree.render(return_value=True), str(query.statement)) == (
+        expected
+    )
+    db.close()
+
+
+def test_relation_plans_of_concurrent_processes_are_merged(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    databases = []
+    for name in ("book", "tag"):
+        db = Database(uri="sqlite:///src.db", cache_dir="cache")
+        db.reflect()
+        parse(db, **{"from": name}).relation_tree
+        databases.append(db)
+    for db in databases:
+        db.close()
+
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    assert len(db.relation_plans.plans) == 2
+    db.close()
@@ -0,0 +1,149 @@
+import datetime
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+)
+
+from dbcut.loader import InsertLoader, PrimaryKeyIndex, SQLiteLoader, get_loader
+
+
+def make_metadata():
+    metadata = MetaData()
+    Table(
+        "author",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(50)),
+        Column("favorite_book_id", Integer, ForeignKey("book.id"), nullable=True),
+    )
+    Table(
+        "book",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("title", String(50)),
+        Column("author_id", Integer, ForeignKey("author.id"), nullable=True),
+    )
+    return metadata
+
+
+def test_rows_are_inserted_with_cycles_deferred():
+    metadata = make_metadata()
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    rows = {
+        "book": [
+            {"id": 1, "title": "Dune", "author_id": 1},
+            {"id": 2, "title": "Emma", "author_id": 2},
+        ],
+        "author": [
+            {"id": 1, "name": "Herbert", "favorite_book_id": 1},
+            {"id": 2, "name": "Austen", "favorite_book_id": None},
+        ],
+    }
+    with engine.begin() as connection:
+        loader = InsertLoader(connection, metadata)
+        assert loader.deferred_columns == {
+            "author": {"favorite_book_id"},
+            "book": {"author_id"},
+        }
+        assert loader.load(rows) == 4
+
+    with engine.connect() as connection:
+        authors = connection.execute(
+            metadata.tables["author"].select().order_by("id")
+        ).fetchall()
+        books = connection.execute(
+            metadata.tables["book"].select().order_by("id")
+        ).fetchall()
+    assert [tuple(r) for r in authors] == [(1, "Herbert", 1), (2, "Austen", None)]
+    assert [tuple(r) for r in books] == [(1, "Dune", 1), (2, "Emma", 2)]
+
+
+def test_duplicated_rows_are_ignored():
+    metadata = make_metadata()
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    rows = {"author": [{"id": 1, "name": "Herbert"}]}
+    with engine.begin() as connection:
+        loader = InsertLoader(connection, metadata)
+        loader.load(rows)
+        loader.load(rows)
+        count = connection.execute("SELECT count(*) FROM author").scalar()
+    assert count == 1
+
+
+def test_rows_already_loaded_are_skipped():
+    metadata = make_metadata()
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    index = PrimaryKeyIndex()
+    with engine.begin() as connection:
+        loader = InsertLoader(connection, metadata, index)
+        assert loader.load({"author": [{"id": 1, "name": "Herbert"}]}) == 1
+        rows = {"author": [{"id": 1, "name": "Herbert"}, {"id": 2, "name": "Austen"}]}
+        assert loader.load(rows) == 1
+    assert index.hits == {"author": 1}
+    assert index.misses == {"author": 2}
+    assert len(index) == 2
+
+
+def test_sqlite_native_loader_matches_insert_loader():
+    metadata = MetaData()
+    Table(
+        "event",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(50)),
+        Column("created_at", DateTime),
+    )
+    rows = {
+        "event": [
+            {"id": 1, "name": "start", "created_at": datetime.datetime(2021, 4, 1)},
+            {"id": 2, "name": None, "created_at": None},
+        ]
+    }
+    results = []
+    for name in ("insert", "native"):
+        engine = create_engine("sqlite://")
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+            loader = get_loader(connection, metadata, name)
+            if name == "native":
+                assert isinstance(loader, SQLiteLoader)
+                loader.native_insert(metadata.tables["event"], rows["event"])
+            else:
+                loader.load(rows)
+            results.append(
+                connection.execute("SELECT * FROM event ORDER BY id").fetchall()
+            )
+    assert results[0] == results[1]
+
+
+def test_native_loader_falls_back_to_insert_after_a_dbapi_error():
+    metadata = make_metadata()
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    calls = []
+
+    class FailingLoader(SQLiteLoader):
+        def native_insert(self, table, rows):
+            calls.append(table.name)
+            # raw DBAPI cursors raise errors not wrapped by SQLAlchemy
+            self.dbapi_connection.cursor().execute("SELECT * FROM missing")
+
+    with engine.begin() as connection:
+        loader = FailingLoader(connection, metadata)
+        assert loader.load({"author": [{"id": 1, "name": "Herbert"}]}) == 1
+        assert loader.load({"book": [{"id": 1, "title": "Dune"}]}) == 1
+        authors = connection.execute("SELECT count(*) FROM author").scalar()
+        books = connection.execute("SELECT count(*) FROM book").scalar()
+    assert (authors, books) == (1, 1)
+    assert not loader.native_available
+    assert calls == ["author"]
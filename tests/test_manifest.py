@@ -0,0 +1,111 @@
+import os
+
+from dbcut.database import Database
+from dbcut.manifest import CacheManifest, CacheStats, evict_cache
+
+from .test_extractor import make_database, parse
+
+
+def test_cached_queries_are_indexed_in_the_manifest(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    query = parse(db, **{"from": "book", "limit": 5, "backref_depth": 0})
+    assert not query.is_cached
+    query.save_to_cache()
+    assert query.is_cached
+    assert not os.path.exists(query.cache_basename + ".count")
+
+    (entry,) = db.cache_manifest.entries()
+    assert os.path.samefile(entry.path, query.cache_file)
+    assert (entry.size, entry.count, entry.rows, entry.codec) == (
+        os.path.getsize(query.cache_file),
+        5,
+        10,
+        "none",
+    )
+    assert entry.fingerprint == db.schema_fingerprint
+    assert entry.created == entry.accessed
+    count, batches = query.load_from_cache()
+    assert count == 5
+    assert db.cache_manifest.get(query.cache_file).accessed > entry.accessed
+
+    # the entries of another schema are ignored
+    db._schema_fingerprint = "changed"
+    assert not query.is_cached
+    db.close()
+
+    manifest = CacheManifest("cache")
+    assert [entry.path for entry in manifest.purge()] == [entry.path]
+    assert manifest.entries() == []
+    assert not os.path.exists(query.cache_file)
+    manifest.close()
+
+
+def test_least_recently_used_queries_are_evicted(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    books = parse(db, **{"from": "book", "limit": 50, "backref_depth": 0})
+    authors = parse(db, **{"from": "author", "limit": 2, "backref_depth": 0})
+    for query in (books, authors):
+        query.save_to_cache()
+    manifest = db.cache_manifest
+    assert list(evict_cache(manifest, 1024 ** 3)) == []
+
+    # the books were cached first but read last
+    list(books.load_from_cache()[1])
+    size = manifest.disk_usage()
+    evicted = evict_cache(manifest, size - 1)
+    assert [os.path.basename(entry.path) for entry in evicted] == [
+        os.path.basename(authors.cache_file)
+    ]
+    assert books.is_cached and not authors.is_cached
+    assert not os.path.exists(authors.cache_file)
+    assert manifest.disk_usage() < size
+
+    stored = db.row_store.connection.execute(
+        "SELECT table_name, COUNT(*) FROM rows GROUP BY table_name"
+    )
+    assert dict(stored) == {"author": 10, "book": 50}
+    db.close()
+
+
+def test_only_the_rows_of_the_evicted_queries_are_removed(tmpdir, monkeypatch):
+    make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    db = Database(uri="sqlite:///src.db", cache_dir="cache")
+    db.reflect()
+    books = parse(db, **{"from": "book", "limit": 5, "backref_depth": 0})
+    tags = parse(db, **{"from": "tag", "limit": 3, "backref_depth": 0})
+    for query in (books, tags):
+        query.save_to_cache()
+    # the key file of the tags cannot be read anymore
+    with open(tags.cache_file, "wb") as fd:
+        fd.write(b"corrupted")
+    # rows stored by another process, whose query is not in the manifest yet
+    db.row_store.put("tag", [((0,), {"id": 0, "label": "tag 0"})])
+
+    evicted = evict_cache(db.cache_manifest, 0)
+    assert len(evicted) == 2
+    stored = db.row_store.connection.execute(
+        "SELECT table_name, COUNT(*) FROM rows GROUP BY table_name"
+    )
+    assert dict(stored) == {"tag": 4}
+    db.close()
+
+
+def test_cache_stats_persist_in_the_manifest(tmpdir):
+    manifest = CacheManifest(str(tmpdir))
+    stats = CacheStats(manifest)
+    stats.incr("hits")
+    stats.incr("bytes_saved", 100)
+    assert stats.totals()["hits"] == 1
+    stats.save()
+    stats.incr("hits")
+    stats.save()
+    manifest.close()
+    totals = CacheStats(CacheManifest(str(tmpdir))).totals()
+    assert (totals["hits"], totals["misses"], totals["bytes_saved"]) == (2, 0, 100)
@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+import pytest
+from mlalchemy.errors import InvalidTableError
+from sqlalchemy import event
+
+from dbcut.cli.context import Context
+from dbcut.cli.operations import PipelinedExecutor, copy_query, sync_schema
+from dbcut.configuration import Configuration
+from dbcut.loader import get_loader
+from dbcut.parser import parse_query
+
+from .test_extractor import make_database
+
+QUERIES = [
+    {"from": "book", "limit": False},
+    {"from": "author", "limit": 3},
+    {"from": "tag", "limit": 2},
+    {"from": "book", "limit": 5, "offset": 10},
+]
+
+
+def make_context(tmpdir, monkeypatch, destination="dest.db", **options):
+    if not tmpdir.join("src.db").exists():
+        make_database(tmpdir).close()
+    monkeypatch.chdir(tmpdir)
+    with open("dbcut.yml", "w") as f:
+        f.write(
+            "cache: cache\n"
+            "databases:\n"
+            "  source_uri: sqlite:///src.db\n"
+            "  destination_uri: sqlite:///%s\n" % destination
+        )
+    ctx = Context()
+    ctx.config = Configuration("dbcut.yml")
+    ctx.no_cache = True
+    for name, value in options.items():
+        setattr(ctx, name, value)
+    ctx.src_db.reflect()
+    return ctx
+
+
+def root_ids(batches):
+    return [[obj.id for obj in batch] for batch in batches]
+
+
+def test_pipelined_batches_come_out_in_query_order(tmpdir, monkeypatch):
+    ctx = make_context(tmpdir, monkeypatch, batch_size=7)
+    expected = [
+        root_ids(parse_query(q.copy(), ctx.src_db.session, ctx.config).iter_batches(7))
+        for q in QUERIES
+    ]
+    executor = PipelinedExecutor(ctx, QUERIES, jobs=3, queue_depth=2)
+    results = []
+    for query, (batches, count, using_cache) in executor:
+        assert not using_cache
+        results.append(root_ids(batches))
+    assert results == expected
+
+
+def test_pipelined_queues_are_bounded(tmpdir, monkeypatch):
+    ctx = make_context(tmpdir, monkeypatch, batch_size=2)
+    jobs, queue_depth = 2, 1
+    executor = PipelinedExecutor(ctx, QUERIES, jobs=jobs, queue_depth=queue_depth)
+    for index, (query, (batches, count, using_cache)) in enumerate(executor):
+        for batch in batches:
+            # let the workers fill the queues
+            time.sleep(0.01)
+            assert max(queue.qsize() for queue in executor.queues) <= queue_depth
+            # at most jobs + 1 queries in flight
+            assert min(executor.next_index, len(QUERIES)) <= index + jobs + 1
+
+
+def test_worker_exception_reaches_the_writer(tmpdir, monkeypatch):
+    ctx = make_context(tmpdir, monkeypatch)
+    queries = [{"from": "author", "limit": 2}, {"from": "missing"}]
+    executor = PipelinedExecutor(ctx, queries, jobs=2)
+    consumed = []
+    with pytest.raises(InvalidTableError):
+        for query, (batches, count, using_cache) in executor:
+            consumed.append(root_ids(batches))
+    assert consumed == [[[9, 8]]]
+    assert executor.stopped.is_set()
+
+
+def test_pipeline_utilisation_is_reported(tmpdir, monkeypatch, capsys):
+    ctx = make_context(tmpdir, monkeypatch)
+    executor = PipelinedExecutor(ctx, QUERIES, jobs=2)
+    for query, (batches, count, using_cache) in executor:
+        list(batches)
+    executor.report()
+    err = capsys.readouterr().err
+    assert "Pipeline stages utilisation" in err
+    assert "fetch (2 workers)" in err
+    assert "insert" in err
+    assert "Total time" in err
+
+
+def test_batches_are_committed_one_by_one(tmpdir, monkeypatch):
+    contents = []
+    for batch_size in (3, None):
+        destination = "dest-%s.db" % batch_size
+        ctx = make_context(tmpdir, monkeypatch, destination, batch_size=batch_size)
+        sync_schema(ctx)
+        query = parse_query(
+            {"from": "author", "limit": 7}, ctx.src_db.session, ctx.config
+        )
+        commits = []
+        with ctx.dest_db.no_fkc_session() as session:
+            event.listen(session, "after_commit", lambda session: commits.append(1))
+            loader = get_loader(session, ctx.dest_db.metadata, "insert")
+            copy_query(ctx, query, session, loader, 0, 1)
+        assert len(commits) == (3 if batch_size else 1)
+        conn = sqlite3.connect(destination)
+        contents.append(
+            {
+                table: sorted(conn.execute("SELECT * FROM %s" % table))
+                for table in ("author", "book", "tag", "book_tag")
+            }
+        )
+        conn.close()
+    assert contents[0]["author"]
+    assert contents[0] == contents[1]
@@ -1,7 +1,13 @@
+import subprocess
+import sys
+import threading
+import time
 import unittest
 from collections import OrderedDict
 
-from dbcut.utils import sorted_nested_dict
+import pytest
+
+from dbcut.utils import AtomicFile, FileLock, sorted_nested_dict
 
 
 def test_simple_dict_is_sorted():
@@ -56,3 +62,71 @@ def test_non_dicts_are_untouched():
 
     data = Custom()
     assert data is sorted_nested_dict(data)
+
+
+def test_atomic_file_replaces_the_file_once_committed(tmpdir):
+    path = str(tmpdir.join("file"))
+    with open(path, "wb") as fd:
+        fd.write(b"old")
+    atomic_file = AtomicFile(path)
+    atomic_file.file.write(b"new")
+    with open(path, "rb") as fd:
+        assert fd.read() == b"old"
+    atomic_file.commit()
+    with open(path, "rb") as fd:
+        assert fd.read() == b"new"
+
+    with pytest.raises(ValueError):
+        with AtomicFile(path) as fd:
+            fd.write(b"half-written")
+            raise ValueError()
+    with open(path, "rb") as fd:
+        assert fd.read() == b"new"
+    assert tmpdir.listdir() == [tmpdir.join("file")]
+
+
+def test_file_lock_waits_for_other_processes(tmpdir):
+    path = str(tmpdir.join("file.lock"))
+    child = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, time\n"
+            "from dbcut.utils import FileLock\n"
+            "lock = FileLock(sys.argv[1])\n"
+            "lock.acquire()\n"
+            "print('locked', flush=True)\n"
+            "time.sleep(0.5)\n",
+            path,
+        ],
+        stdout=subprocess.PIPE,
+    )
+    assert child.stdout.readline() == b"locked\n"
+    start = time.time()
+    lock = FileLock(path)
+    assert lock.acquire()
+    assert time.time() - start > 0.2
+    assert not FileLock(path).acquire(blocking=False)
+    lock.release()
+    assert FileLock(path).acquire(blocking=False)
+    child.wait()
+
+
+def test_file_lock_waits_for_other_threads(tmpdir):
+    path = str(tmpdir.join("file.lock"))
+    lock = FileLock(path)
+    assert lock.acquire()
+    acquired = []
+
+    def acquire():
+        other = FileLock(path)
+        acquired.append(other.acquire())
+        other.release()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.2)
+    assert acquired == []
+    lock.release()
+    thread.join()
+    assert acquired == [True]